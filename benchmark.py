@@ -0,0 +1,211 @@
+# ==============================================================================
+# Benchmark suite of the SIDH and M-SIDH implementations
+#
+# Every operation (parameter construction, private key generation, public key,
+# public key validation, shared secret) is run a few times untimed to warm the
+# caches, then timed over a number of repetitions. Results are reported in
+# seconds (median, percentiles) along with the machine they were measured on,
+# and can be compared against a baseline saved by a previous run.
+#
+# Author: Malo RANZETTI
+# Date: Spring 2023
+# ==============================================================================
+
+import os
+import json
+import time
+import platform
+import subprocess
+import argparse
+import multiprocessing
+import numpy as np
+from colorama import Back, Style
+import msidh
+import sidh
+
+def measure(operation, setup=None, warmup=1, repetitions=5):
+    '''
+    Times in s of repetitions calls of operation(*setup()), after warmup
+    untimed calls. setup is not timed and prepares fresh arguments for
+    every call.
+    '''
+    times = []
+    for i in range(warmup + repetitions):
+        args = setup() if setup is not None else ()
+        start = time.perf_counter()
+        operation(*args)
+        elapsed = time.perf_counter() - start
+        if i >= warmup:
+            times.append(elapsed)
+    return times
+
+def statistics(times):
+    '''
+    Summary of a list of times in s
+    '''
+    return {
+        'repetitions': len(times),
+        'median': float(np.median(times)),
+        'mean': float(np.mean(times)),
+        'std': float(np.std(times)),
+        'min': float(np.min(times)),
+        'max': float(np.max(times)),
+        'p10': float(np.percentile(times, 10)),
+        'p90': float(np.percentile(times, 90)),
+    }
+
+def machine_metadata():
+    '''
+    Description of the machine and of the code the benchmarks ran on
+    '''
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    import sage.version
+    return {
+        'date': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'host': platform.node(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': multiprocessing.cpu_count(),
+        'python': platform.python_version(),
+        'sage': sage.version.version,
+        'commit': commit,
+    }
+
+def benchmark_protocol(create_scheme, warmup=1, repetitions=5):
+    '''
+    Time the operations of the two parties of the protocol returned by
+    create_scheme(). The public keys are computed with a fresh private key
+    every time, the shared secrets and validations against one public key
+    of the other party.
+    '''
+    results = {'parameters': statistics(measure(create_scheme, warmup=warmup, repetitions=repetitions))}
+    scheme = create_scheme()
+    parties = {'A': scheme.interfaceA, 'B': scheme.interfaceB}
+    for name, party in parties.items():
+        other = parties['B' if name == 'A' else 'A']
+        other_public_key = other.compute_public_key(other.generate_private_key())
+        new_key = lambda: (party.generate_private_key(), )
+
+        print(f"{Back.LIGHTBLACK_EX}Party {name}{Style.RESET_ALL}")
+        operations = {
+            'keygen': (party.generate_private_key, None),
+            'public_key': (party.compute_public_key, new_key),
+            'shared_secret': (lambda k: party.compute_shared_secret(k, other_public_key), new_key),
+        }
+        if hasattr(party, 'validate_public_key'):
+            operations['validation'] = (lambda: party.validate_public_key(other_public_key), None)
+        for operation, (fn, setup) in operations.items():
+            results[f"{name}.{operation}"] = statistics(measure(fn, setup, warmup, repetitions))
+            print(f"{operation}: {results[f'{name}.{operation}']['median']} s (median)")
+    return results
+
+def sidh_schemes(curves=None, backend='weierstrass'):
+    '''
+    (name, create_scheme) of the SIDH curves, all of sidh.available_curves by default
+    '''
+    for curve in curves or sidh.available_curves:
+        yield f"sidh/{curve}", lambda curve=curve: sidh.create_protocol(sidh.get_curve(curve), backend=backend)
+
+def msidh_schemes(directory="./models", backend='weierstrass', pairing='weil'):
+    '''
+    (name, create_scheme) of the M-SIDH parameter files of the directory. A
+    pickled file is skipped when the same parameters are also in the binary
+    format (see run.py --convert).
+    '''
+    filenames = sorted(os.listdir(directory))
+    for filename in filenames:
+        stem, extension = os.path.splitext(filename)
+        if extension not in (msidh.PARAMETERS_EXTENSION, ".pickle"):
+            continue
+        if extension == ".pickle" and stem + msidh.PARAMETERS_EXTENSION in filenames:
+            continue
+        # create_protocol_from_file takes paths relative to ./models
+        path = os.path.relpath(os.path.join(directory, filename), "./models")
+        yield f"msidh/{filename}", lambda path=path: msidh.create_protocol_from_file(path, backend=backend, pairing=pairing)
+
+def run_suite(schemes, warmup=1, repetitions=5, generate=(), generate_repetitions=1):
+    '''
+    Benchmark every (name, create_scheme) of schemes, and the generation of
+    M-SIDH parameters (MSIDHpArbitrary) for the security levels in generate.
+    '''
+    results = {'metadata': machine_metadata(), 'units': 's', 'benchmarks': {}}
+    results['metadata'].update({'warmup': warmup, 'repetitions': repetitions})
+    for name, create_scheme in schemes:
+        print(f"{Back.YELLOW}{Style.BRIGHT}--++-- BENCHMARK {name} --++--{Style.RESET_ALL}")
+        results['benchmarks'][name] = benchmark_protocol(create_scheme, warmup, repetitions)
+    for lam in generate:
+        print(f"{Back.YELLOW}{Style.BRIGHT}--++-- BENCHMARK generation lambda={lam} --++--{Style.RESET_ALL}")
+        times = measure(lambda: msidh.MSIDHpArbitrary(lam), warmup=0, repetitions=generate_repetitions)
+        results['benchmarks'][f"msidh/generate-{lam}"] = {'generation': statistics(times)}
+    return results
+
+def compare(results, baseline, threshold=0.1):
+    '''
+    Operations whose median is more than threshold (relative) slower than in
+    the baseline, as (benchmark, operation, baseline median, median) tuples.
+    Operations missing from either side are ignored.
+    '''
+    regressions = []
+    for name, operations in results['benchmarks'].items():
+        reference = baseline['benchmarks'].get(name, {})
+        for operation, stats in operations.items():
+            if operation not in reference:
+                continue
+            before, after = reference[operation]['median'], stats['median']
+            if after > before * (1 + threshold):
+                regressions.append((name, operation, before, after))
+    return regressions
+
+def save_results(results, path):
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump(results, f, indent=2)
+    os.replace(tmp, path)
+    print(f"Results written to {path}")
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+                    prog='M-SIDH Benchmarks',
+                    description='Benchmark suite of the SIDH and M-SIDH key exchanges.')
+    parser.add_argument('--sidh', type=str, nargs='*', choices=list(sidh.available_curves.keys()),
+                        help='SIDH curves to benchmark (all if no curve is given)')
+    parser.add_argument('--msidh', action='store_true', help='benchmark every parameter file of --models')
+    parser.add_argument('--models', type=str, default='./models', help='directory of the M-SIDH parameter files')
+    parser.add_argument('--generate', type=int, nargs='*', default=[], help='security levels to benchmark the M-SIDH parameter generation for')
+    parser.add_argument('-w', '--warmup', type=int, default=1, help='untimed runs of every operation')
+    parser.add_argument('-r', '--repetitions', type=int, default=5, help='timed runs of every operation')
+    parser.add_argument('--backend', type=str, choices=['weierstrass', 'montgomery'], default='weierstrass', help='curve arithmetic used by the parties')
+    parser.add_argument('--pairing', type=str, choices=['weil', 'tate'], default='weil', help='pairing used by the MSIDH parties to validate public keys')
+    parser.add_argument('-o', '--output', type=str, default='benchmark_results.json', help='file the results are written to')
+    parser.add_argument('--baseline', type=str, help='results of a previous run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown of the median reported as a regression')
+    args = parser.parse_args()
+
+    schemes = []
+    if args.sidh is not None:
+        schemes += list(sidh_schemes(args.sidh, args.backend))
+    if args.msidh:
+        schemes += list(msidh_schemes(args.models, args.backend, args.pairing))
+    if not schemes and not args.generate:
+        print("Nothing to benchmark, use --sidh, --msidh or --generate")
+        exit(1)
+
+    results = run_suite(schemes, args.warmup, args.repetitions, args.generate)
+    save_results(results, args.output)
+
+    if args.baseline:
+        regressions = compare(results, load_results(args.baseline), args.threshold)
+        for name, operation, before, after in regressions:
+            print(f"{Back.RED}REGRESSION{Style.RESET_ALL} {name} {operation}: {before} s -> {after} s")
+        if regressions:
+            exit(1)
+        print(f"{Back.GREEN}No regression{Style.RESET_ALL} against {args.baseline}")
@@ -0,0 +1,111 @@
+# ==============================================================================
+# Compressed wire encoding of the SIDH / M-SIDH public keys
+#
+# A public key (E, R, S) is sent as the Montgomery coefficient A of E and the
+# x-coordinates of R, S and R - S on the Montgomery model, each element of Fp2
+# as two fixed size big-endian integers:
+#
+#   version (1 byte) | A | x(R) | x(S) | x(R - S)
+#
+# x(R - S) fixes the relative sign of R and S when the points are recovered,
+# so the Weil pairing of the recovered points is the one of the sent points.
+#
+# Author: Malo RANZETTI
+# Date: Spring 2023
+# ==============================================================================
+
+from sage.all import *
+import kummer
+
+ENCODING_VERSION = 1
+
+def element_size(F):
+    '''
+    Bytes of one element of Fp2
+    '''
+    return 2 * ((F.characteristic().nbits() + 7) // 8)
+
+def public_key_size(F):
+    '''
+    Bytes of an encoded public key over F
+    '''
+    return 1 + 4 * element_size(F)
+
+def _encode_element(z, size):
+    c = z.polynomial().list()
+    c = c + [0] * (2 - len(c))
+    return b"".join(int(x).to_bytes(size // 2, "big") for x in c)
+
+def _decode_element(F, data, size):
+    '''
+    Element of Fp2 encoded by _encode_element. Both coordinates must be less
+    than p, so that every element has a single encoding
+    '''
+    half = size // 2
+    c = [int.from_bytes(data[:half], "big"), int.from_bytes(data[half:size], "big")]
+    if any(x >= F.characteristic() for x in c):
+        raise ValueError("Invalid encoded public key: coordinate out of range")
+    return F(c)
+
+def encode_public_key(public_key, backend='weierstrass'):
+    '''
+    Bytes of a public key returned by compute_public_key of a party using the
+    given backend: (E, R, S) for 'weierstrass', (A, x(R), x(S), x(R - S)) for
+    'montgomery'
+    '''
+    if backend == 'montgomery':
+        elements = public_key
+    else:
+        E, R, S = public_key
+        curve, alpha, s = kummer.montgomery_model(E)
+        A, C = kummer.montgomery_coefficients(curve)
+        elements = (A / C, ) + tuple(kummer.affine(kummer.to_xz(P, alpha, s)) for P in (R, S, R - S))
+
+    size = element_size(elements[0].parent())
+    return bytes([ENCODING_VERSION]) + b"".join(_encode_element(z, size) for z in elements)
+
+def decode_public_key(data, F, backend='weierstrass'):
+    '''
+    Public key over F in the form expected by compute_shared_secret of a party
+    using the given backend. For 'weierstrass', E is recovered as a Weierstrass
+    model of the Montgomery curve (or of its twist, see kummer.lift_basis) and
+    R, S are lifted on it, which does not change the kernels nor the pairings.
+
+    A ValueError is raised for a wrong version byte or length, or a coordinate
+    that is not reduced modulo p:
+
+        sage: import encoding
+        sage: F = GF((431, 2), 'x')
+        sage: data = bytearray(encoding.public_key_size(F))
+        sage: data[0] = encoding.ENCODING_VERSION
+        sage: encoding.decode_public_key(bytes(data), F, 'montgomery')
+        (0, 0, 0, 0)
+        sage: data[1:3] = int(431).to_bytes(2, "big")
+        sage: encoding.decode_public_key(bytes(data), F, 'montgomery')
+        Traceback (most recent call last):
+        ...
+        ValueError: Invalid encoded public key: coordinate out of range
+        sage: encoding.decode_public_key(bytes(data[:-1]), F, 'montgomery')
+        Traceback (most recent call last):
+        ...
+        ValueError: Invalid encoded public key
+    '''
+    size = element_size(F)
+    if len(data) != public_key_size(F) or data[0] != ENCODING_VERSION:
+        raise ValueError("Invalid encoded public key")
+    elements = tuple(_decode_element(F, data[1 + i*size:1 + (i+1)*size], size) for i in range(4))
+    if backend == 'montgomery':
+        return elements
+    return kummer.lift_basis(*elements)
+
+def size_report(p):
+    '''
+    Public key sizes in bytes for the prime p: compressed (this encoding), and
+    uncompressed affine (a4, a6 and the two points of a short Weierstrass model)
+    '''
+    F_bytes = 2 * ((Integer(p).nbits() + 7) // 8)
+    return {
+        'p_bits': Integer(p).nbits(),
+        'compressed': 1 + 4 * F_bytes,
+        'uncompressed': 6 * F_bytes,
+    }
@@ -78,11 +78,20 @@ AUTHORS:
   documentation and tests, equality testing
 """
 
+import json
+import os
+import time
+from contextlib import contextmanager
+
 from sage.structure.richcmp import op_EQ
 from sage.misc.cachefunc import cached_method
 from sage.structure.sequence import Sequence
 
 from sage.arith.misc import prod
+from sage.misc.cachefunc import cached_function
+from sage.rings.integer import Integer
+from sage.rings.infinity import infinity
+from sage.env import DOT_SAGE
 
 from sage.schemes.elliptic_curves.ell_generic import EllipticCurve_generic
 from sage.schemes.elliptic_curves.hom import EllipticCurveHom, compare_via_evaluation
@@ -90,7 +99,495 @@ from sage.schemes.elliptic_curves.ell_curve_isogeny import EllipticCurveIsogeny
 from sage.schemes.elliptic_curves.weierstrass_morphism import WeierstrassIsomorphism, identity_morphism
 from sage.schemes.elliptic_curves.hom_velusqrt import EllipticCurveHom_velusqrt
 
-# TODO: Implement sparse strategies? (cf. the SIKE cryptosystem)
+# Degree from which √élu beats Vélu, per bit size of the characteristic.
+# Filled by calibrate_velusqrt_crossover() and persisted in this file.
+VELUSQRT_CROSSOVER_FILE = os.path.join(DOT_SAGE, 'velusqrt_crossover.json')
+_velusqrt_crossover = None
+
+
+def _load_velusqrt_crossover():
+    """
+    Return the table of √élu crossover degrees, loading it from
+    :data:`VELUSQRT_CROSSOVER_FILE` on first use.
+    """
+    global _velusqrt_crossover
+    if _velusqrt_crossover is None:
+        _velusqrt_crossover = {}
+        if os.path.exists(VELUSQRT_CROSSOVER_FILE):
+            with open(VELUSQRT_CROSSOVER_FILE) as f:
+                _velusqrt_crossover = {int(bits): l for bits, l in json.load(f).items()}
+    return _velusqrt_crossover
+
+
+def velusqrt_crossover(F, table=None):
+    """
+    Return the smallest prime degree for which isogenies over the
+    finite field ``F`` are computed with :class:`EllipticCurveHom_velusqrt`.
+
+    The value is taken from the calibrated entry whose characteristic
+    size is closest to that of ``F``; without any calibration, or if
+    √élu never won the benchmark, ``+Infinity`` is returned.
+
+    The entries are looked up in ``table`` (bit size to degree) if
+    given, and in the table of :data:`VELUSQRT_CROSSOVER_FILE` otherwise.
+
+    EXAMPLES::
+
+        sage: from sage.schemes.elliptic_curves import hom_composite
+        sage: table = {}
+        sage: hom_composite.velusqrt_crossover(GF(2^89-1), table)
+        +Infinity
+        sage: hom_composite.set_velusqrt_crossover(GF(2^127-1), 211, save=False, table=table)
+        sage: hom_composite.velusqrt_crossover(GF(2^89-1), table)
+        211
+        sage: hom_composite.set_velusqrt_crossover(GF(2^127-1), None, save=False, table=table)
+        sage: hom_composite.velusqrt_crossover(GF(2^89-1), table)
+        +Infinity
+    """
+    if table is None:
+        table = _load_velusqrt_crossover()
+    if not table:
+        return infinity
+    bits = F.characteristic().nbits()
+    l = table[min(table, key=lambda b: abs(b - bits))]
+    return infinity if l is None else Integer(l)
+
+
+def set_velusqrt_crossover(F, l, save=True, table=None):
+    """
+    Record ``l`` as the √élu crossover degree for finite fields of the
+    same characteristic size as ``F`` (``None`` meaning never), and
+    write the table to :data:`VELUSQRT_CROSSOVER_FILE` if ``save`` is set.
+
+    ``table`` is the table to update, the one of
+    :data:`VELUSQRT_CROSSOVER_FILE` by default.
+    """
+    if table is None:
+        table = _load_velusqrt_crossover()
+    table[F.characteristic().nbits()] = None if l is None else int(l)
+    if save:
+        os.makedirs(os.path.dirname(VELUSQRT_CROSSOVER_FILE), exist_ok=True)
+        with open(VELUSQRT_CROSSOVER_FILE, 'w') as f:
+            json.dump({str(bits): l for bits, l in sorted(table.items())}, f, indent=2)
+
+
+def _isogeny_step(E, K, l):
+    """
+    Return the isogeny of prime degree `l` with kernel generated by `K`,
+    using √élu from the calibrated crossover degree on and Vélu below.
+
+    EXAMPLES::
+
+        sage: from sage.schemes.elliptic_curves import hom_composite
+        sage: E = EllipticCurve(GF(419), [1,0])
+        sage: K = list(sorted(E(0).division_points(5)))[1]
+        sage: hom_composite._isogeny_step(E, K, 5).degree()
+        5
+    """
+    # The order is known, do not let the constructors recompute it
+    K._order = Integer(l)
+    if l != 2 and l >= velusqrt_crossover(E.base_field()):
+        return EllipticCurveHom_velusqrt(E, K)
+    return EllipticCurveIsogeny(E, K)
+
+
+def _time_isogeny_step(algorithm, E, K, Q, repeat):
+    """
+    Return the best time over ``repeat`` runs of constructing the
+    isogeny ``algorithm(E, K)`` and evaluating it at ``Q``.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        algorithm(E, K)(Q)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def calibrate_velusqrt_crossover(E, order, degrees, repeat=3, save=True):
+    """
+    Benchmark :class:`EllipticCurveIsogeny` against
+    :class:`EllipticCurveHom_velusqrt` on the curve `E` and record the
+    resulting crossover degree for its base field.
+
+    INPUT:
+
+    - ``E`` -- an elliptic curve over a finite field
+    - ``order`` -- a multiple of the order of every point of `E`
+      (for instance the group exponent)
+    - ``degrees`` -- the prime degrees to benchmark; each must divide
+      ``order``
+    - ``repeat`` (default: 3) -- number of timings per degree, the
+      best one is kept
+    - ``save`` (default: ``True``) -- whether to persist the result
+
+    OUTPUT: the smallest benchmarked degree from which √élu was faster
+    for all larger benchmarked degrees, or ``None`` if it never was.
+
+    EXAMPLES::
+
+        sage: from sage.schemes.elliptic_curves import hom_composite
+        sage: E = EllipticCurve(GF(419), [1,0])
+        sage: l = hom_composite.calibrate_velusqrt_crossover(E, 420, [3, 5, 7], save=False)
+        sage: l in (None, 3, 5, 7)
+        True
+    """
+    timings = []
+    Q = E.random_point()
+    for l in sorted(set(Integer(l) for l in degrees)):
+        if l == 2:
+            continue
+        K = E(0)
+        while K.is_zero():
+            K = (order // l) * E.random_point()
+        K._order = l
+        t_velu = _time_isogeny_step(EllipticCurveIsogeny, E, K, Q, repeat)
+        t_sqrt = _time_isogeny_step(EllipticCurveHom_velusqrt, E, K, Q, repeat)
+        timings.append((l, t_sqrt < t_velu))
+
+    crossover = None
+    for l, faster in reversed(timings):
+        if not faster:
+            break
+        crossover = l
+    set_velusqrt_crossover(E.base_field(), crossover, save)
+    return crossover
+
+
+# Fitted costs in seconds of the building blocks of the factored isogenies,
+# per bit size of the characteristic. Filled by calibrate_isogeny_costs()
+# and persisted in this file. Each model maps a part to the coefficients
+# (a, b) of a + b*x, where x is the bit size of `l` for the scalar
+# multiplication by `l` ('mul'), `l` for Vélu ('velu', 'velu_eval') and
+# `\sqrt{l}` for √élu ('velusqrt', 'velusqrt_eval').
+ISOGENY_COSTS_FILE = os.path.join(DOT_SAGE, 'isogeny_costs.json')
+_isogeny_costs = None
+
+_COST_VARIABLES = {
+    'mul': lambda l: Integer(l).nbits(),
+    'velu': float,
+    'velu_eval': float,
+    'velusqrt': lambda l: float(l)**0.5,
+    'velusqrt_eval': lambda l: float(l)**0.5,
+}
+
+
+def _load_isogeny_costs():
+    """
+    Return the table of fitted isogeny cost models, loading it from
+    :data:`ISOGENY_COSTS_FILE` on first use.
+    """
+    global _isogeny_costs
+    if _isogeny_costs is None:
+        _isogeny_costs = {}
+        if os.path.exists(ISOGENY_COSTS_FILE):
+            with open(ISOGENY_COSTS_FILE) as f:
+                _isogeny_costs = {int(bits): model for bits, model in json.load(f).items()}
+    return _isogeny_costs
+
+
+def isogeny_cost_model(F):
+    """
+    Return the cost model fitted on the characteristic size closest to
+    that of the finite field ``F``, or ``None`` without any calibration.
+    """
+    table = _load_isogeny_costs()
+    if not table:
+        return None
+    bits = F.characteristic().nbits()
+    return table[min(table, key=lambda b: abs(b - bits))]
+
+
+def set_isogeny_cost_model(F, model, save=True):
+    """
+    Record ``model`` as the cost model for finite fields of the same
+    characteristic size as ``F``, and write the table to
+    :data:`ISOGENY_COSTS_FILE` if ``save`` is set.
+    """
+    table = _load_isogeny_costs()
+    table[F.characteristic().nbits()] = model
+    if save:
+        os.makedirs(os.path.dirname(ISOGENY_COSTS_FILE), exist_ok=True)
+        with open(ISOGENY_COSTS_FILE, 'w') as f:
+            json.dump({str(bits): m for bits, m in sorted(table.items())}, f, indent=2)
+
+
+def predicted_cost(model, part, l):
+    """
+    Return the time in seconds predicted by ``model`` for the part
+    ``part`` (see :data:`ISOGENY_COSTS_FILE`) of a step of degree `l`.
+
+    EXAMPLES::
+
+        sage: from sage.schemes.elliptic_curves import hom_composite
+        sage: hom_composite.predicted_cost({'velu': [1.0, 0.5]}, 'velu', 7)
+        4.5
+    """
+    a, b = model[part]
+    return a + b * _COST_VARIABLES[part](l)
+
+
+def _fit_line(points):
+    """
+    Least squares coefficients `(a, b)` of `y = a + bx` through the
+    pairs `(x, y)` of ``points``.
+    """
+    n = len(points)
+    mx = sum(x for x, _ in points) / n
+    my = sum(y for _, y in points) / n
+    sxx = sum((x - mx)**2 for x, _ in points)
+    b = sum((x - mx) * (y - my) for x, y in points) / sxx if sxx else 0.0
+    return [my - b * mx, b]
+
+
+def _best_time(f, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def benchmark_isogeny_costs(E, order, degrees, repeat=3):
+    """
+    Time, for every prime `l` in ``degrees``, the building blocks of an
+    `l`-isogeny step on the curve `E`: the multiplication of a point by
+    `l`, and the construction and the evaluation at a point of the
+    isogeny with :class:`EllipticCurveIsogeny` and, for odd `l`, with
+    :class:`EllipticCurveHom_velusqrt`.
+
+    ``order`` must be a multiple of the order of every point of `E`
+    divisible by every degree. The best of ``repeat`` timings is kept.
+
+    OUTPUT: a list of dictionaries, one per degree, with the degree
+    ``'l'`` and the time in seconds of each part.
+
+    EXAMPLES::
+
+        sage: from sage.schemes.elliptic_curves import hom_composite
+        sage: E = EllipticCurve(GF(419), [1,0])
+        sage: timings = hom_composite.benchmark_isogeny_costs(E, 420, [2, 3, 5, 7])
+        sage: [t['l'] for t in timings], 'velusqrt' in timings[0], 'velusqrt' in timings[1]
+        ([2, 3, 5, 7], False, True)
+    """
+    timings = []
+    Q = E.random_point()
+    for l in sorted(set(Integer(l) for l in degrees)):
+        K = E(0)
+        while K.is_zero():
+            K = (order // l) * E.random_point()
+        K._order = l
+        t = {'l': int(l)}
+        t['mul'], _ = _best_time(lambda: l * Q, repeat)
+        algorithms = [('velu', EllipticCurveIsogeny)]
+        if l != 2:
+            algorithms.append(('velusqrt', EllipticCurveHom_velusqrt))
+        for name, algorithm in algorithms:
+            t[name], phi = _best_time(lambda: algorithm(E, K), repeat)
+            t[name + '_eval'], _ = _best_time(lambda: phi(Q), repeat)
+        timings.append(t)
+    return timings
+
+
+def fit_isogeny_cost_model(timings):
+    """
+    Fit the cost model of :data:`ISOGENY_COSTS_FILE` on the output of
+    :func:`benchmark_isogeny_costs`.
+
+    EXAMPLES::
+
+        sage: from sage.schemes.elliptic_curves import hom_composite
+        sage: timings = [{'l': l, 'mul': 1.0, 'velu': 2.0*l, 'velu_eval': 1.0*l} for l in (3, 5, 7)]
+        sage: hom_composite.fit_isogeny_cost_model(timings)
+        {'mul': [1.0, 0.0], 'velu': [0.0, 2.0], 'velu_eval': [0.0, 1.0]}
+    """
+    model = {}
+    for part, variable in _COST_VARIABLES.items():
+        points = [(variable(t['l']), t[part]) for t in timings if part in t]
+        if points:
+            model[part] = _fit_line(points)
+    return model
+
+
+def calibrate_isogeny_costs(E, order, degrees, repeat=3, save=True):
+    """
+    Benchmark the isogeny steps of the given prime degrees on `E` (see
+    :func:`benchmark_isogeny_costs`), fit and record their cost model
+    for its base field, and record as √élu crossover the smallest
+    benchmarked degree from which the model predicts √élu to be faster
+    for all larger benchmarked degrees.
+
+    The cost model is then used by :func:`_strategy_costs` to weigh
+    multiplications against evaluations in optimal strategies.
+
+    OUTPUT: the model and the timings it was fitted on.
+    """
+    timings = benchmark_isogeny_costs(E, order, degrees, repeat)
+    model = fit_isogeny_cost_model(timings)
+    set_isogeny_cost_model(E.base_field(), model, save)
+
+    crossover = None
+    if 'velusqrt' in model:
+        for l in reversed([t['l'] for t in timings if t['l'] != 2]):
+            velu = predicted_cost(model, 'velu', l) + predicted_cost(model, 'velu_eval', l)
+            sqrt = predicted_cost(model, 'velusqrt', l) + predicted_cost(model, 'velusqrt_eval', l)
+            if sqrt >= velu:
+                break
+            crossover = l
+    set_velusqrt_crossover(E.base_field(), crossover, save)
+    return model, timings
+
+
+# The profile being recorded, see IsogenyProfile. When it is ``None``
+# the instrumented functions only pay for a call to _lap() per step.
+_profile = None
+
+
+class IsogenyProfile:
+    r"""
+    Timings of the prime-degree steps of the factored isogenies and of
+    the named phases (see :func:`profile_phase`) computed while the
+    profile is active.
+
+    Each step is recorded with its degree `l` and the time in seconds
+    spent computing its kernel point (scalar multiplications),
+    constructing the isogeny (codomain) and pushing points through it.
+    The scalar multiplications and evaluations of the product tree
+    done between two steps are charged to the next step.
+
+    Only one profile is active at a time; steps computed in forked
+    worker processes are not recorded.
+
+    EXAMPLES::
+
+        sage: from sage.schemes.elliptic_curves import hom_composite
+        sage: E = EllipticCurve(GF(419), [1,0])
+        sage: with hom_composite.IsogenyProfile() as profile:
+        ....:     phi = EllipticCurveHom_composite(E, E(42,321))
+        sage: sorted(step['l'] for step in profile.steps)
+        [2, 2, 3, 5, 7]
+        sage: sorted(profile.histogram())
+        [2, 3]
+    """
+    STEP_FIELDS = ('l', 'kernel', 'codomain', 'eval')
+
+    def __init__(self):
+        self.steps = []
+        self.phases = {}
+        self._current = dict.fromkeys(self.STEP_FIELDS[1:], 0.0)
+
+    def start(self):
+        """
+        Make this profile the active one.
+        """
+        global _profile
+        if _profile is not None and _profile is not self:
+            raise RuntimeError('another isogeny profile is already active')
+        _profile = self
+        return self
+
+    def stop(self):
+        """
+        Stop recording.
+        """
+        global _profile
+        if _profile is self:
+            _profile = None
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _end_step(self, l):
+        self.steps.append(dict(self._current, l=int(l)))
+        self._current = dict.fromkeys(self.STEP_FIELDS[1:], 0.0)
+
+    def histogram(self):
+        r"""
+        Return the steps aggregated by bit size of their degree, as a
+        dictionary mapping the bit size to the number of steps, the
+        smallest and largest degree and the total time of each part.
+        """
+        bins = {}
+        for step in self.steps:
+            bits = Integer(step['l']).nbits()
+            b = bins.setdefault(bits, {'steps': 0, 'min_l': step['l'], 'max_l': step['l'],
+                                       'kernel': 0.0, 'codomain': 0.0, 'eval': 0.0})
+            b['steps'] += 1
+            b['min_l'] = min(b['min_l'], step['l'])
+            b['max_l'] = max(b['max_l'], step['l'])
+            for key in self.STEP_FIELDS[1:]:
+                b[key] += step[key]
+        return bins
+
+    def summary(self):
+        """
+        Return the histogram and the total time of each phase (number
+        of calls and seconds).
+        """
+        return {
+            'histogram': {str(bits): b for bits, b in sorted(self.histogram().items())},
+            'phases': {name: {'calls': len(t), 'time': sum(t)} for name, t in self.phases.items()},
+        }
+
+    def export(self, path):
+        """
+        Write the profile to ``path``: the steps, the histogram and the
+        phases as JSON if the name ends with ``.json``, otherwise one
+        CSV row per step.
+        """
+        with open(path, 'w') as f:
+            if path.endswith('.json'):
+                json.dump(dict(self.summary(), steps=self.steps), f, indent=2)
+            else:
+                f.write(','.join(self.STEP_FIELDS) + '\n')
+                for step in self.steps:
+                    f.write(','.join(str(step[key]) for key in self.STEP_FIELDS) + '\n')
+
+
+def _lap(key=None, start=None):
+    """
+    Charge the time elapsed since ``start`` to the part ``key`` of the
+    step being computed, if a profile is active, and return the current
+    time (``None`` when profiling is off).
+    """
+    if _profile is None:
+        return None
+    now = time.perf_counter()
+    if key is not None:
+        _profile._current[key] += now - start
+    return now
+
+
+def _end_step(l):
+    """
+    Close the record of the `l`-isogeny step just computed.
+    """
+    if _profile is not None:
+        _profile._end_step(l)
+
+
+@contextmanager
+def profile_phase(name):
+    """
+    Record the time spent in the block under ``name`` in the active
+    profile, if any.
+    """
+    if _profile is None:
+        yield
+        return
+    profile = _profile
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.phases.setdefault(name, []).append(time.perf_counter() - start)
 
 
 def _eval_factored_isogeny(phis, P):
@@ -118,12 +615,111 @@ def _eval_factored_isogeny(phis, P):
     return P
 
 
-def _compute_factored_isogeny_prime_power(P, l, e):
+def _strategy_costs(l, F=None):
+    r"""
+    Return the estimated relative costs ``(mul_cost, eval_cost)``
+    of multiplying a point by `l` and of evaluating an `l`-isogeny
+    at a point.
+
+    If a cost model was calibrated for fields of the size of ``F``
+    (see :func:`calibrate_isogeny_costs`), the costs are the times it
+    predicts, using the evaluation time of the algorithm chosen by
+    :func:`_isogeny_step`. Otherwise, a scalar multiplication by `l`
+    is counted as the number of doublings and additions of the
+    double-and-add chain, while Vélu-type evaluation is linear in the
+    number `(l-1)/2` of kernel points.
+
+    EXAMPLES::
+
+        sage: from sage.schemes.elliptic_curves import hom_composite
+        sage: hom_composite._strategy_costs(2)
+        (1, 1)
+        sage: hom_composite._strategy_costs(3)
+        (2, 1)
+        sage: hom_composite._strategy_costs(31)
+        (8, 15)
     """
+    l = Integer(l)
+    model = isogeny_cost_model(F) if F is not None else None
+    if model is not None:
+        evaluation = 'velu_eval'
+        if l != 2 and 'velusqrt_eval' in model and l >= velusqrt_crossover(F):
+            evaluation = 'velusqrt_eval'
+        # Negative predictions from the extrapolated lines would break the strategy
+        return (max(predicted_cost(model, 'mul', l), 1e-9),
+                max(predicted_cost(model, evaluation, l), 1e-9))
+    return l.nbits() + l.popcount() - 2, max(1, (l - 1) // 2)
+
+
+@cached_function
+def _optimal_strategy(e, mul_cost, eval_cost):
+    r"""
+    Return an optimal strategy for computing an isogeny of degree
+    `l^e` as a chain of `l`-isogenies, where multiplying a point by
+    `l` costs ``mul_cost`` and evaluating an `l`-isogeny at a point
+    costs ``eval_cost``.
+
+    The strategy is returned as a tuple ``splits`` such that, for a
+    kernel point of order `l^h` with `h \geq 2`, one first computes
+    the `h - i` isogenies with kernel `l^i` times that point, where
+    `i` = ``splits[h]``, before handling the remaining `i` steps.
+    Optimal strategies have optimal substructure, so a single split
+    per height describes the whole traversal (cf. the SIKE
+    cryptosystem). Results are cached, hence computed at most once
+    per ``(e, mul_cost, eval_cost)``.
+
+    EXAMPLES::
+
+        sage: from sage.schemes.elliptic_curves import hom_composite
+        sage: hom_composite._optimal_strategy(4, 1, 1)
+        (0, 0, 1, 1, 2)
+
+    Expensive multiplications lead to the strategy which keeps every
+    intermediate point and pushes it through all later isogenies,
+    expensive evaluations to the one which recomputes each kernel
+    point from the original `P`::
+
+        sage: hom_composite._optimal_strategy(4, 100, 1)
+        (0, 0, 1, 1, 1)
+        sage: hom_composite._optimal_strategy(4, 1, 100)
+        (0, 0, 1, 2, 3)
+    """
+    cost = [0, 0]
+    splits = [0, 0]
+    for h in range(2, e + 1):
+        best = None
+        for i in range(1, h):
+            c = cost[h - i] + cost[i] + i * mul_cost + (h - i) * eval_cost
+            if best is None or c < best:
+                best, split = c, i
+        cost.append(best)
+        splits.append(split)
+    return tuple(splits)
+
+
+def _push_points(phi, points):
+    """
+    Replace every point in the list ``points`` by its image under ``phi``.
+    """
+    if points:
+        points[:] = [phi(Q) for Q in points]
+
+
+def _compute_factored_isogeny_prime_power(P, l, e, strategy=None, points=None):
+    r"""
     This method takes a point `P` of order `l^e` and returns
     a sequence of degree-`l` isogenies whose composition has
     the subgroup generated by `P` as its kernel.
 
+    If a list ``points`` is given, its entries are replaced by their
+    images, pushed through each step as soon as it is computed.
+
+    The ``strategy`` parameter selects how the kernel points of
+    the individual steps are obtained: ``None`` recomputes them
+    from `P` at every step, while ``'optimal'`` traverses the
+    optimal strategy returned by :func:`_optimal_strategy`, which
+    needs `O(e \log e)` instead of `O(e^2)` multiplications by `l`.
+
     EXAMPLES::
 
         sage: from sage.schemes.elliptic_curves import hom_composite
@@ -135,31 +731,183 @@ def _compute_factored_isogeny_prime_power(P, l, e):
         (0 : 1 : 0)
         sage: [phi.degree() for phi in phis] == [l]*e
         True
+
+    ::
+
+        sage: E = EllipticCurve(GF(2^61-1), [1,0])
+        sage: P = 3^20 * E.random_point()
+        sage: (l,e), = P.order().factor()
+        sage: psis = hom_composite._compute_factored_isogeny_prime_power(P,l,e, strategy='optimal')
+        sage: hom_composite._eval_factored_isogeny(psis, P)
+        (0 : 1 : 0)
+        sage: phis = hom_composite._compute_factored_isogeny_prime_power(P,l,e)
+        sage: psis[-1].codomain() == phis[-1].codomain()
+        True
+
+    ::
+
+        sage: Q = E.random_point()
+        sage: points = [Q, 2*Q]
+        sage: phis = hom_composite._compute_factored_isogeny_prime_power(P,l,e, strategy='optimal', points=points)
+        sage: points == [hom_composite._eval_factored_isogeny(phis, Q), hom_composite._eval_factored_isogeny(phis, 2*Q)]
+        True
     """
+    if strategy == 'optimal':
+        splits = _optimal_strategy(e, *_strategy_costs(l, P.curve().base_field()))
+        return _traverse_strategy(P, l, e, splits, points)
+    if strategy is not None:
+        raise ValueError(f'unknown strategy: {strategy}')
+
     E = P.curve()
     phis = []
     for i in range(e):
+        t = _lap()
         K = l**(e-1-i) * P
-
-        # Test whether l > 500, if yes use velusqrt
-        phi = None
-        if True: # l <= limit: This is weird. The velusqrt should be working better but it is not.
-            phi = EllipticCurveIsogeny(E, K)
-        else:
-            phi = EllipticCurveHom_velusqrt(E, K)
-
+        t = _lap('kernel', t)
+        phi = _isogeny_step(E, K, l)
         E = phi.codomain()
+        t = _lap('codomain', t)
         P = phi(P)
+        _push_points(phi, points)
+        _lap('eval', t)
+        _end_step(l)
         phis.append(phi)
     return phis
 
 
-def _compute_factored_isogeny_single_generator(P, order=None):
+def _traverse_strategy(P, l, e, splits, points=None):
+    r"""
+    This method takes a point `P` of order `l^e` and returns the
+    sequence of degree-`l` isogenies with kernel `\langle P\rangle`,
+    following the strategy ``splits`` (see :func:`_optimal_strategy`).
+
+    Intermediate points are kept on a stack together with the
+    number of steps left for them once the isogenies below them
+    have been computed; they are pushed through each new step,
+    along with the entries of the list ``points`` if given.
+
+    EXAMPLES::
+
+        sage: from sage.schemes.elliptic_curves import hom_composite
+        sage: E = EllipticCurve(GF(8191), [1,0])
+        sage: P = 2^12 * E.random_point()
+        sage: (l,e), = P.order().factor()
+        sage: splits = hom_composite._optimal_strategy(e, 1, 1)
+        sage: phis = hom_composite._traverse_strategy(P, l, e, splits)
+        sage: [phi.degree() for phi in phis] == [l]*e
+        True
+        sage: hom_composite._eval_factored_isogeny(phis, P)
+        (0 : 1 : 0)
+    """
+    if e == 0:
+        return []
+    E = P.curve()
+    phis = []
+    stack = []
+    R, h = P, e
+    while True:
+        t = _lap()
+        while h > 1:
+            i = splits[h]
+            stack.append((R, i))
+            R = l**i * R
+            h -= i
+        t = _lap('kernel', t)
+        phi = _isogeny_step(E, R, l)
+        E = phi.codomain()
+        t = _lap('codomain', t)
+        phis.append(phi)
+        _push_points(phi, points)
+        stack = [(phi(S), s) for S, s in stack]
+        _lap('eval', t)
+        _end_step(l)
+        if not stack:
+            return phis
+        R, h = stack.pop()
+
+
+def _split_factors(factors):
+    """
+    Split a list of prime-power factors `(l, e)` into two nonempty
+    parts whose products have roughly the same bit size.
+
+    EXAMPLES::
+
+        sage: from sage.schemes.elliptic_curves import hom_composite
+        sage: hom_composite._split_factors(list(factor(2^2*3*5*7*11*13)))
+        ([(2, 2), (3, 1), (5, 1), (7, 1)], [(11, 1), (13, 1)])
+    """
+    sizes = [e * Integer(l).nbits() for l, e in factors]
+    total = sum(sizes)
+    acc = 0
+    for i, size in enumerate(sizes):
+        acc += size
+        if 2 * acc >= total:
+            break
+    i = max(1, min(i + 1, len(factors) - 1))
+    return factors[:i], factors[i:]
+
+
+def _compute_factored_isogeny_product_tree(P, factors, strategy=None, points=None):
+    r"""
+    This method takes a point `P` whose order factors as ``factors``
+    (a list of pairs `(l, e)`) and returns a sequence of prime-degree
+    isogenies whose composition has the subgroup generated by `P` as
+    its kernel.
+
+    The factors are split recursively into two halves: the isogeny
+    for the first half is computed from `P` multiplied by the order
+    of the second half, after which `P` is pushed through it and the
+    second half is handled. The scalars shrink along the recursion,
+    so only `O(n \log n)` scalar multiplications (counted in small
+    primes) are needed for `n` factors, instead of `O(n^2)` when the
+    cofactor of each prime is cleared from the full order.
+
+    The entries of the list ``points``, if given, are replaced by
+    their images as in :func:`_compute_factored_isogeny_prime_power`.
+
+    EXAMPLES::
+
+        sage: from sage.schemes.elliptic_curves import hom_composite
+        sage: E = EllipticCurve(GF(419), [1,0])
+        sage: P = E(42,321)
+        sage: phis = hom_composite._compute_factored_isogeny_product_tree(P, list(P.order().factor()))
+        sage: list(sorted(phi.degree() for phi in phis))
+        [2, 2, 3, 5, 7]
+        sage: hom_composite._eval_factored_isogeny(phis, P)
+        (0 : 1 : 0)
+        sage: phis[-1].codomain() == hom_composite._compute_factored_isogeny_single_generator(P)[-1].codomain()
+        True
+    """
+    if not factors:
+        return []
+    if len(factors) == 1:
+        (l, e), = factors
+        return _compute_factored_isogeny_prime_power(P, l, e, strategy, points)
+    left, right = _split_factors(factors)
+    t = _lap()
+    Q = prod(l**e for l, e in right) * P
+    _lap('kernel', t)
+    phis = _compute_factored_isogeny_product_tree(Q, left, strategy, points)
+    t = _lap()
+    P = _eval_factored_isogeny(phis, P)
+    _lap('eval', t)
+    return phis + _compute_factored_isogeny_product_tree(P, right, strategy, points)
+
+
+def _compute_factored_isogeny_single_generator(P, order=None, strategy=None, decomposition=None, points=None):
     """
     This method takes a point `P` and returns a sequence of
     prime-degree isogenies whose composition has the subgroup
     generated by `P` as its kernel.
 
+    With ``decomposition='product_tree'`` the kernel is split
+    using :func:`_compute_factored_isogeny_product_tree`, which is
+    much faster when the order of `P` has many prime factors.
+
+    The entries of the list ``points``, if given, are replaced by
+    their images as in :func:`_compute_factored_isogeny_prime_power`.
+
     EXAMPLES::
 
         sage: from sage.schemes.elliptic_curves import hom_composite
@@ -170,21 +918,34 @@ def _compute_factored_isogeny_single_generator(P, order=None):
         [2, 2, 3, 5, 7]
         sage: hom_composite._eval_factored_isogeny(phis, P)
         (0 : 1 : 0)
+        sage: psis = hom_composite._compute_factored_isogeny_single_generator(P, decomposition='product_tree')
+        sage: psis[-1].codomain() == phis[-1].codomain()
+        True
     """
     phis = []
     h = order
     if h == None:
         h = P.order()
+    h = Integer(h)
     factors = h.factor()
+    if decomposition == 'product_tree':
+        return _compute_factored_isogeny_product_tree(P, list(factors), strategy, points)
+    if decomposition is not None:
+        raise ValueError(f'unknown decomposition: {decomposition}')
     for l,e in factors:
         h //= l**e
-        psis = _compute_factored_isogeny_prime_power(h*P, l, e)
+        t = _lap()
+        Q = h*P
+        _lap('kernel', t)
+        psis = _compute_factored_isogeny_prime_power(Q, l, e, strategy, points)
+        t = _lap()
         P = _eval_factored_isogeny(psis, P)
+        _lap('eval', t)
         phis += psis
     return phis
 
 
-def _compute_factored_isogeny(kernel):
+def _compute_factored_isogeny(kernel, strategy=None, decomposition=None, points=None):
     """
     This method takes a set of points on an elliptic curve
     and returns a sequence of isogenies whose composition
@@ -206,26 +967,60 @@ def _compute_factored_isogeny(kernel):
     while ker:
         K, ker = ker[0], ker[1:]
         print(K, ker)
-        psis = _compute_factored_isogeny_single_generator(K)
+        psis = _compute_factored_isogeny_single_generator(K, strategy=strategy, decomposition=decomposition, points=points)
         ker = [_eval_factored_isogeny(psis, P) for P in ker]
         phis += psis
     return phis
 
 
+# Set by EllipticCurveHom_composite.eval_parallel() before forking.
+_forked_isogeny = None
+_forked_points = None
+
+
+def _eval_forked_point(i):
+    """
+    Evaluate the isogeny being evaluated in parallel at its `i`-th point.
+    Runs in a forked worker process.
+    """
+    return _forked_isogeny(_forked_points[i])
+
+
 class EllipticCurveHom_composite(EllipticCurveHom):
 
     _degree = None
     _phis = None
     _single_point_kernel = False
+    _pushed_points = ()
 
-    def __init__(self, E, kernel, codomain=None, model=None, kernel_order=None):
+    def __init__(self, E, kernel, codomain=None, model=None, kernel_order=None, strategy=None, decomposition=None, points=None):
         """
         Construct a composite isogeny with given kernel (and optionally,
         prescribed codomain curve). The isogeny is decomposed into steps
         of prime degree.
 
         The ``codomain`` and ``model`` parameters have the same meaning
-        as for :class:`EllipticCurveIsogeny`.
+        as for :class:`EllipticCurveIsogeny`. If the kernel is given by
+        a single point, ``kernel_order`` may be passed to avoid computing
+        the order of that point.
+
+        The ``strategy`` parameter selects the traversal of the steps
+        of prime-power degree: ``None`` recomputes every kernel point
+        from the generator, while ``'optimal'`` follows a precomputed
+        optimal strategy (see :func:`_optimal_strategy`), which is much
+        faster for large exponents.
+
+        The ``decomposition`` parameter selects how a kernel generator
+        is split into its prime-power parts: ``None`` clears the full
+        cofactor of each prime in turn, while ``'product_tree'`` splits
+        the order recursively (see
+        :func:`_compute_factored_isogeny_product_tree`), which is much
+        faster for orders with many distinct prime factors.
+
+        The points of `E` given in ``points`` are pushed through each
+        step while it is computed, and their images are returned by
+        :meth:`pushed_points`. This avoids walking the factors again
+        for points whose images are known to be needed.
 
         EXAMPLES::
 
@@ -271,23 +1066,53 @@ class EllipticCurveHom_composite(EllipticCurveHom):
             sage: psi = EllipticCurveHom_composite(E, K, model='montgomery')
             sage: psi.codomain().a_invariants()
             (0, ..., 0, 1, 0)
+
+        ::
+
+            sage: E = EllipticCurve(GF(2^61-1), [1,0])
+            sage: K = 3^20 * E.random_point()
+            sage: phi = EllipticCurveHom_composite(E, K, strategy='optimal')
+            sage: phi == EllipticCurveHom_composite(E, K)
+            True
+
+        ::
+
+            sage: E = EllipticCurve(GF(419), [1,0])
+            sage: P = E(42,321)
+            sage: phi = EllipticCurveHom_composite(E, P, decomposition='product_tree')
+            sage: phi == EllipticCurveHom_composite(E, P)
+            True
+
+        ::
+
+            sage: Q = E(4,149)
+            sage: phi = EllipticCurveHom_composite(E, P, decomposition='product_tree', points=[Q, 2*Q])
+            sage: phi.pushed_points() == (phi(Q), phi(2*Q))
+            True
         """
 
         if not isinstance(E, EllipticCurve_generic):
             raise ValueError(f'not an elliptic curve: {E}')
 
+        single_point_kernel = False
         if not isinstance(kernel, list) and not isinstance(kernel, tuple):
             kernel = [kernel]
-            _single_point_kernel = True
+            single_point_kernel = True
 
         for P in kernel:
             if P not in E:
                 raise ValueError(f'given point {P} does not lie on {E}')
 
-        if not _single_point_kernel:
-            self._phis = _compute_factored_isogeny(kernel)
+        if points is not None:
+            points = list(points)
+            for P in points:
+                if P not in E:
+                    raise ValueError(f'given point {P} does not lie on {E}')
+
+        if not single_point_kernel:
+            self._phis = _compute_factored_isogeny(kernel, strategy, decomposition, points)
         else:
-            self._phis = _compute_factored_isogeny_single_generator(kernel[0], kernel_order)
+            self._phis = _compute_factored_isogeny_single_generator(kernel[0], kernel_order, strategy, decomposition, points)
 
         if not self._phis:
             self._phis = [identity_morphism(E)]
@@ -307,8 +1132,12 @@ class EllipticCurveHom_composite(EllipticCurveHom):
                 self._phis[-1]._set_post_isomorphism(iso)
             else:
                 self._phis.append(iso)
+            if points:
+                points = [iso(P) for P in points]
 
         self._phis = tuple(self._phis)  # make immutable
+        if points is not None:
+            self._pushed_points = tuple(points)
         self.__perform_inheritance_housekeeping()
 
     def __perform_inheritance_housekeeping(self):
@@ -487,6 +1316,59 @@ class EllipticCurveHom_composite(EllipticCurveHom):
                 f'\n  From: {self._domain}' \
                 f'\n  To:   {self._codomain}'
 
+    def pushed_points(self):
+        r"""
+        Return the images of the points passed as ``points`` on
+        construction, as a tuple.
+
+        EXAMPLES::
+
+            sage: from sage.schemes.elliptic_curves.hom_composite import EllipticCurveHom_composite
+            sage: E = EllipticCurve(GF(419), [1,0])
+            sage: Q = E(4,149)
+            sage: phi = EllipticCurveHom_composite(E, E(42,321), points=[Q])
+            sage: phi.pushed_points() == (phi(Q),)
+            True
+        """
+        return self._pushed_points
+
+    def eval_parallel(self, points, processes=None):
+        r"""
+        Evaluate this composite isogeny at each point of ``points``,
+        one point per worker process.
+
+        The workers are forked, so the factors are inherited rather
+        than serialized; only the points travel between processes.
+        This needs the ``fork`` start method, i.e., a POSIX system.
+
+        INPUT:
+
+        - ``points`` -- a sequence of points on the domain
+        - ``processes`` (optional) -- the number of worker processes,
+          by default one per point
+
+        EXAMPLES::
+
+            sage: from sage.schemes.elliptic_curves.hom_composite import EllipticCurveHom_composite
+            sage: E = EllipticCurve(GF(419), [1,0])
+            sage: Q = E(4,149)
+            sage: phi = EllipticCurveHom_composite(E, E(42,321))
+            sage: phi.eval_parallel([Q, 2*Q]) == [phi(Q), phi(2*Q)]
+            True
+        """
+        global _forked_isogeny, _forked_points
+        import multiprocessing
+        points = list(points)
+        if not points:
+            return []
+        _forked_isogeny, _forked_points = self, points
+        try:
+            with multiprocessing.get_context('fork').Pool(processes or len(points)) as pool:
+                images = pool.map(_eval_forked_point, range(len(points)))
+        finally:
+            _forked_isogeny, _forked_points = None, None
+        return [self._codomain(list(Q)) for Q in images]
+
     def factors(self):
         r"""
         Return the factors of this composite isogeny as a tuple.
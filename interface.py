@@ -7,6 +7,8 @@
 
 from sage.all import *
 from colorama import Back, Style
+import multiprocessing
+import pickle
 import time
 
 # ==============================================================================
@@ -66,22 +68,88 @@ class Party:
 # ==============================================================================
 class Pipe:
     def __init__(self, partyA, partyB):
+        '''
+        Every message is encoded by the sender and decoded by the receiver with
+        the encoding of their DH_interface, the encoded bytes are what is kept
+        as transmitted. The size and the encoding and decoding times of every
+        message are recorded in self.metrics.
+        '''
         self.partyA = partyA
         self.partyB = partyB
         self.transmitted_messages_to_A = []
         self.transmitted_messages_to_B = []
+        self.metrics = []
+
+    def _transmit(self, sender, receiver, message, transmitted):
+        timer_start = time.perf_counter()
+        data = sender.interface.encode_public_key(message)
+        encoded = time.perf_counter()
+        decoded = receiver.interface.decode_public_key(data)
+        decode_time = time.perf_counter() - encoded
+        transmitted.append(data)
+        self.metrics.append({
+            'from': sender.name,
+            'bytes': len(data),
+            'encode_time': encoded - timer_start,
+            'decode_time': decode_time,
+        })
+        receiver.register_public_key(decoded)
 
     def transmit_A_to_B(self, message):
-        self.transmitted_messages_to_B.append(message)
-        self.partyB.register_public_key(message)
+        self._transmit(self.partyA, self.partyB, message, self.transmitted_messages_to_B)
 
     def transmit_B_to_A(self, message):
-        self.transmitted_messages_to_A.append(message)
-        self.partyA.register_public_key(message)
+        self._transmit(self.partyB, self.partyA, message, self.transmitted_messages_to_A)
 
     def get_total_trasmitted_bytes(self):
-        # TODO: implement
-        return len(self.transmitted_messages_to_A) + len(self.transmitted_messages_to_B)
+        return sum(m['bytes'] for m in self.metrics)
+
+    def coding_time_ns(self):
+        '''
+        Total encoding and decoding time of the messages in ns, which the
+        protocol leaves out of its total time (it is reported by summary)
+        '''
+        return round(sum(m['encode_time'] + m['decode_time'] for m in self.metrics) * 1e9)
+
+    def summary(self):
+        '''
+        Total bytes, and total encoding and decoding times in s, of the messages
+        '''
+        return {
+            'bytes': self.get_total_trasmitted_bytes(),
+            'encode_time': sum(m['encode_time'] for m in self.metrics),
+            'decode_time': sum(m['decode_time'] for m in self.metrics),
+        }
+
+# ==============================================================================
+# Concurrent execution of the parties
+# ==============================================================================
+
+# Parties of the protocol being run concurrently, set before forking the workers
+_concurrent_parties = {}
+
+def _run_party_keys(name):
+    '''
+    Generate the private and public key of a party in a worker process.
+    Returns the keys and the CPU time spent.
+    '''
+    party = _concurrent_parties[name]
+    cpu_start = time.process_time()
+    party.generate_private_key()
+    party.compute_public_key()
+    return party.private_key, party.public_key, time.process_time() - cpu_start
+
+def _run_party_shared_secret(name, private_key, other_public_key):
+    '''
+    Compute the shared secret of a party in a worker process.
+    Returns the secret and the CPU time spent.
+    '''
+    party = _concurrent_parties[name]
+    cpu_start = time.process_time()
+    party.private_key = private_key
+    party.register_public_key(other_public_key)
+    party.compute_shared_secret()
+    return party.shared_secret, time.process_time() - cpu_start
 
 # Protocol class for abstract Diffie-Hellman
 class DH_interface:
@@ -102,6 +170,15 @@ class DH_interface:
     
     def compute_shared_secret(self, private_key, other_public_key):
         raise NotImplementedError
+
+    def encode_public_key(self, public_key):
+        '''
+        Bytes sent for a public key, pickle unless the scheme has its own encoding
+        '''
+        return pickle.dumps(public_key)
+
+    def decode_public_key(self, data):
+        return pickle.loads(data)
     
     def __str__(self):
         return f"{Style.DIM}DH-interface >> {self.__class__.__name__} \n {self.print_public_parameters()} {Style.RESET_ALL}"
@@ -127,7 +204,16 @@ class DH_Protocol:
         self.alice.compute_shared_secret()
         self.bob.compute_shared_secret()
 
-    def run(self):
+    def run(self, concurrent=False):
+        '''
+        Run the protocol once, return whether the secrets match and the total time in ns.
+        The encoding and decoding of the public keys are not part of the total
+        time, their times are in self.transfer, so that it stays comparable with
+        the results measured when the keys were passed as objects.
+        If concurrent is set, both parties run in parallel in their own process.
+        '''
+        if concurrent:
+            return self.run_concurrent()
 
         print(f"{Back.YELLOW}{Style.BRIGHT}--++-- STARTING PROTOCOL --++--{Style.RESET_ALL}")
 
@@ -160,6 +246,8 @@ class DH_Protocol:
         print(f"{Back.BLUE}{Style.BRIGHT}--++-- EXCHANGING PUBLIC KEYS --++--{Style.RESET_ALL}")
         network.transmit_A_to_B(self.alice.public_key)
         network.transmit_B_to_A(self.bob.public_key)
+        self.transfer = network.summary()
+        print(f"Transmitted: {self.transfer['bytes']} bytes")
 
 
         # Compute shared secrets
@@ -170,15 +258,66 @@ class DH_Protocol:
         print(f"{Back.LIGHTBLACK_EX}{Style.BRIGHT}--++-- SHARED SECRETS COMPUTED --++--{Style.RESET_ALL}")
 
 
-        total_time = time.time_ns() - TIME
+        total_time = time.time_ns() - TIME - network.coding_time_ns()
         print(f"{Back.YELLOW}{Style.BRIGHT}--++-- PROTOCOL COMPLETED --++--{Style.RESET_ALL}")
         print(f"Total time: {total_time / 1e9} s")
         return check_secrets(self.alice.shared_secret, self.bob.shared_secret), total_time
 
+    def run_concurrent(self):
+        '''
+        Run the protocol with Alice and Bob computing in parallel, each in a
+        forked worker process (the Sage work does not release the GIL).
+        The wall time and the CPU time of each party are stored in self.timings.
+        '''
+        global _concurrent_parties
 
+        print(f"{Back.YELLOW}{Style.BRIGHT}--++-- STARTING PROTOCOL (CONCURRENT) --++--{Style.RESET_ALL}")
+        self.alice = Party(self.interfaceA, "Alice")
+        self.bob = Party(self.interfaceB, "Bob")
+        network = Pipe(self.alice, self.bob)
+        parties = [self.alice, self.bob]
+        cpu_time = {party.name: 0 for party in parties}
 
-
-
-
-
-
+        _concurrent_parties = {party.name: party for party in parties}
+        try:
+            with multiprocessing.get_context('fork').Pool(len(parties)) as pool:
+                TIME = time.time_ns()
+
+                # Generate private and public keys
+                print(f"{Back.LIGHTBLACK_EX}{Style.BRIGHT}--++-- GENERATING KEYS --++--{Style.RESET_ALL}")
+                timer_start = time.time_ns()
+                results = [pool.apply_async(_run_party_keys, (party.name,)) for party in parties]
+                for party, result in zip(parties, results):
+                    party.private_key, party.public_key, cpu = result.get()
+                    cpu_time[party.name] += cpu
+                print(f"Elapsed time: {(time.time_ns() - timer_start) / 1e9} s")
+                print(f"{Back.LIGHTBLACK_EX}{Style.BRIGHT}--++-- KEYS GENERATED --++--{Style.RESET_ALL}")
+
+                # Exchange public keys
+                print(f"{Back.BLUE}{Style.BRIGHT}--++-- EXCHANGING PUBLIC KEYS --++--{Style.RESET_ALL}")
+                network.transmit_A_to_B(self.alice.public_key)
+                network.transmit_B_to_A(self.bob.public_key)
+                self.transfer = network.summary()
+                print(f"Transmitted: {self.transfer['bytes']} bytes")
+
+                # Compute shared secrets
+                print(f"{Back.LIGHTBLACK_EX}{Style.BRIGHT}--++-- COMPUTING SHARED SECRETS --++--{Style.RESET_ALL}")
+                timer_start = time.time_ns()
+                results = [pool.apply_async(_run_party_shared_secret, (party.name, party.private_key, party.other_public_key))
+                           for party in parties]
+                for party, result in zip(parties, results):
+                    party.shared_secret, cpu = result.get()
+                    cpu_time[party.name] += cpu
+                print(f"Elapsed time: {(time.time_ns() - timer_start) / 1e9} s")
+                print(f"{Back.LIGHTBLACK_EX}{Style.BRIGHT}--++-- SHARED SECRETS COMPUTED --++--{Style.RESET_ALL}")
+
+                total_time = time.time_ns() - TIME - network.coding_time_ns()
+        finally:
+            _concurrent_parties = {}
+
+        self.timings = {'wall': total_time / 1e9, 'cpu': cpu_time}
+        print(f"{Back.YELLOW}{Style.BRIGHT}--++-- PROTOCOL COMPLETED --++--{Style.RESET_ALL}")
+        print(f"Total time: {total_time / 1e9} s")
+        for name, cpu in cpu_time.items():
+            print(f"CPU time {name}: {cpu} s")
+        return check_secrets(self.alice.shared_secret, self.bob.shared_secret), total_time
@@ -0,0 +1,152 @@
+# ==============================================================================
+# Pool of precomputed ephemeral key pairs for the M-SIDH parties
+#
+# Generating a key pair (private key and public key isogeny) takes minutes for
+# large security parameters. A KeyPool generates them ahead of time in worker
+# processes and hands each one out exactly once, so that an exchange only pays
+# for the shared secret.
+#
+# Author: Malo RANZETTI
+# Date: Spring 2023
+# ==============================================================================
+
+import os
+import fcntl
+import pickle
+import threading
+import multiprocessing
+from colorama import Back, Style
+
+# Party of a key pool worker, set by _init_worker from the initargs of its pool
+_pool_party = None
+
+def _init_worker(party):
+    global _pool_party
+    _pool_party = party
+
+def _generate_key_pair():
+    private_key = _pool_party.generate_private_key()
+    return private_key, _pool_party.compute_public_key(private_key)
+
+def _open_private(path, mode):
+    '''
+    Open path for writing, truncated, created readable by the owner only: the
+    pool holds private keys
+    '''
+    return os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), mode)
+
+class KeyPool:
+    def __init__(self, party, path, low=2, high=8, processes=None):
+        '''
+        Keep between low and high (private key, public key) pairs of the party
+        (MSIDH_Party_A or MSIDH_Party_B) ready. Once the pool falls below low
+        pairs, processes workers generate pairs until it holds high again.
+
+        The pool is saved to path (atomically, after every change), and reloaded
+        from it on creation. A pair is removed from the file before take returns
+        it, so a pair is never handed out twice, even across restarts. A lock
+        file keeps a second KeyPool from opening the same path.
+        '''
+        if not 0 <= low <= high or high == 0:
+            raise ValueError("Watermarks must satisfy 0 <= low <= high, high > 0")
+        self.party = party
+        self.path = path
+        self.low = low
+        self.high = high
+        self._id = (type(party).__name__, party.parameters.name)
+
+        self._lock_file = _open_private(path + ".lock", "w")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            raise RuntimeError(f"Key pool {path} is already in use")
+
+        self._keys = []
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                saved = pickle.load(f)
+            if saved["id"] != self._id:
+                self._lock_file.close()
+                raise ValueError(f"Key pool {path} holds keys of {saved['id']}, not {self._id}")
+            self._keys = saved["keys"]
+            print(f"{Back.MAGENTA}Loaded {len(self._keys)} keys from {path}{Style.RESET_ALL}")
+
+        self._pending = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        # Passed to every worker, including the ones the pool respawns, rather
+        # than read from a global that a later KeyPool would overwrite
+        self._workers = multiprocessing.get_context('fork').Pool(processes, initializer=_init_worker, initargs=(party, ))
+        with self._condition:
+            self._schedule()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        with _open_private(tmp, "wb") as f:
+            pickle.dump({"id": self._id, "keys": self._keys}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def _schedule(self):
+        '''
+        Below the low watermark (or when empty), request the pairs missing up to
+        the high one. Called with the condition held.
+        '''
+        if self._closed or (len(self._keys) + self._pending >= self.low and self._keys):
+            return
+        for _ in range(self.high - len(self._keys) - self._pending):
+            self._pending += 1
+            self._workers.apply_async(_generate_key_pair, callback=self._add, error_callback=self._failed)
+
+    def _add(self, pair):
+        with self._condition:
+            self._pending -= 1
+            self._keys.append(pair)
+            self._save()
+            self._condition.notify_all()
+
+    def _failed(self, error):
+        with self._condition:
+            self._pending -= 1
+            # Not rescheduled here, the next take requests the missing pairs again
+            print(f"{Back.RED}Key generation failed: {error}{Style.RESET_ALL}")
+            self._condition.notify_all()
+
+    def take(self, timeout=None):
+        '''
+        Remove a (private key, public key) pair from the pool and return it,
+        waiting up to timeout seconds (forever if None) when the pool is empty
+        '''
+        with self._condition:
+            self._schedule()
+            if not self._condition.wait_for(lambda: self._keys or self._closed, timeout):
+                raise TimeoutError("No key available in the pool")
+            if self._closed:
+                raise RuntimeError("Key pool is closed")
+            pair = self._keys.pop(0)
+            self._save()
+            self._schedule()
+            return pair
+
+    def close(self):
+        '''
+        Stop the workers, the pairs being generated are dropped
+        '''
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._workers.terminate()
+        self._workers.join()
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._lock_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
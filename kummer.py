@@ -0,0 +1,284 @@
+# ==============================================================================
+# x-only arithmetic on the Kummer line of Montgomery curves
+#
+# Points are kept in projective XZ coordinates and curves as (A + 2C : 4C), so
+# the ladders and isogenies never invert nor touch y-coordinates. Odd degree
+# isogenies use the Edwards codomain formula of Meyer and Reith with the image
+# formula of Costello and Hisil, 2-isogenies the formulas of SIKE.
+#
+# Author: Malo RANZETTI
+# Date: Spring 2023
+# ==============================================================================
+
+from sage.all import *
+from sage.schemes.elliptic_curves.hom_composite import _lap, _end_step
+
+def montgomery_curve(A, C=1):
+    '''
+    Curve constant (A + 2C : 4C) of the Montgomery curve y^2 = x^3 + (A/C) x^2 + x
+    '''
+    return (A + 2*C, 4*C)
+
+def montgomery_coefficients(curve):
+    '''
+    (A : C) of the curve, up to a common factor
+    '''
+    A24p, C24 = curve
+    return 4*A24p - 2*C24, C24
+
+def j_invariant(curve):
+    A, C = montgomery_coefficients(curve)
+    A2, C2 = A**2, C**2
+    return 256 * (A2 - 3*C2)**3 / (C2**2 * (A2 - 4*C2))
+
+def affine(P):
+    X, Z = P
+    return X / Z
+
+def xDBL(P, curve):
+    '''
+    x(2P)
+    '''
+    X, Z = P
+    A24p, C24 = curve
+    t0 = (X - Z)**2
+    t1 = (X + Z)**2
+    Z2 = C24 * t0
+    X2 = Z2 * t1
+    t1 = t1 - t0
+    Z2 = (Z2 + A24p * t1) * t1
+    return (X2, Z2)
+
+def xADD(P, Q, PQ):
+    '''
+    x(P + Q) from x(P), x(Q) and x(P - Q)
+    '''
+    XP, ZP = P
+    XQ, ZQ = Q
+    XPQ, ZPQ = PQ
+    u = (XP - ZP) * (XQ + ZQ)
+    v = (XP + ZP) * (XQ - ZQ)
+    return (ZPQ * (u + v)**2, XPQ * (u - v)**2)
+
+def ladder(k, P, curve):
+    '''
+    x(kP) with the Montgomery ladder
+    '''
+    k = Integer(k)
+    if k == 0:
+        return (1, 0)
+    R0, R1 = P, xDBL(P, curve)
+    for bit in reversed(k.bits()[:-1]):
+        if bit:
+            R0, R1 = xADD(R1, R0, P), xDBL(R1, curve)
+        else:
+            R0, R1 = xDBL(R0, curve), xADD(R1, R0, P)
+    return R0
+
+def ladder3pt(m, P, Q, PQ, curve, bits=None):
+    '''
+    x(P + mQ) from x(P), x(Q) and x(P - Q). Every bit of m, up to the given
+    number of bits, costs exactly one doubling and one differential addition.
+    '''
+    m = Integer(m)
+    bits = m.nbits() if bits is None else bits
+    digits = m.bits() + [0] * (bits - m.nbits())
+    # R0 = [2^i] Q, R1 = P + [m mod 2^i] Q, R2 = R1 - R0
+    R0, R1, R2 = Q, P, PQ
+    for bit in digits:
+        if bit:
+            R1 = xADD(R1, R0, R2)
+        else:
+            R2 = xADD(R2, R0, R1)
+        R0 = xDBL(R0, curve)
+    return R1
+
+def _isogeny_2(K, curve, points):
+    X2, Z2 = K
+    if X2 == 0:
+        # Kernel (0, 0): x -> (x^2 + A x + 1) / x lands on y^2 = x^3 - 2A x^2 + (A^2 - 4) x,
+        # brought back to a Montgomery model by scaling x by sqrt(A^2 - 4)
+        start = _lap()
+        A, C = montgomery_coefficients(curve)
+        r = (A**2 - 4*C**2).sqrt()
+        start = _lap('codomain', start)
+        images = [(C*X**2 + A*X*Z + C*Z**2, r*X*Z) for X, Z in points]
+        _lap('eval', start)
+        return montgomery_curve(-2*A, r), images
+
+    # x -> x (x x2 - 1) / (x - x2)
+    start = _lap()
+    s, t = X2 + Z2, X2 - Z2
+    images = []
+    for X, Z in points:
+        t0 = s * (X - Z)
+        t1 = t * (X + Z)
+        images.append((X * (t0 + t1), Z * (t0 - t1)))
+    _lap('eval', start)
+    return (Z2**2 - X2**2, Z2**2), images
+
+def _isogeny_odd(K, l, curve, points):
+    start = _lap()
+    n = (l - 1) // 2
+    multiples = [K]
+    if n > 1:
+        multiples.append(xDBL(K, curve))
+    for _ in range(2, n):
+        multiples.append(xADD(multiples[-1], K, multiples[-2]))
+    sums = [(X + Z, X - Z) for X, Z in multiples]
+
+    # Codomain through the twisted Edwards model a = A + 2C, d = A - 2C
+    A24p, C24 = curve
+    a = A24p**l * prod(s for s, _ in sums)**8
+    d = (A24p - C24)**l * prod(t for _, t in sums)**8
+    start = _lap('codomain', start)
+
+    # x -> x prod((x xi - 1) / (x - xi))^2
+    images = []
+    for X, Z in points:
+        plus, minus = X + Z, X - Z
+        U = V = 1
+        for s, t in sums:
+            t0 = minus * s
+            t1 = plus * t
+            U *= t0 + t1
+            V *= t0 - t1
+        images.append((X * U**2, Z * V**2))
+    _lap('eval', start)
+    return (a, a - d), images
+
+def isogeny_step(K, l, curve, points=()):
+    '''
+    Isogeny of prime degree l with kernel <K>, returns the codomain and the
+    images of the points. The step is recorded in the active isogeny profile
+    of hom_composite, if any.
+    '''
+    if l == 2:
+        step = _isogeny_2(K, curve, list(points))
+    else:
+        step = _isogeny_odd(K, l, curve, list(points))
+    _end_step(l)
+    return step
+
+def _split_factors(factors):
+    '''
+    Split the factors in two non-empty halves of about the same bit size
+    '''
+    total = sum(int(l).bit_length() for l in factors)
+    size = 0
+    for i, l in enumerate(factors):
+        size += int(l).bit_length()
+        if 2 * size >= total:
+            break
+    i = min(max(i + 1, 1), len(factors) - 1)
+    return factors[:i], factors[i:]
+
+def isogeny(K, factors, curve, points=()):
+    '''
+    Isogeny with kernel <K> of order prod(factors), the factors being primes.
+    The prime steps are taken along a balanced product tree: the kernel of the
+    first half is [prod(right)] K, and K is pushed through it to give the kernel
+    of the second half. Returns the codomain and the images of the points.
+    '''
+    if len(factors) == 1:
+        return isogeny_step(K, factors[0], curve, points)
+    left, right = _split_factors(factors)
+    start = _lap()
+    kernel = ladder(prod(right), K, curve)
+    _lap('kernel', start)
+    curve, images = isogeny(kernel, left, curve, [K] + list(points))
+    return isogeny(images[0], right, curve, images[1:])
+
+def prime_factors(factors):
+    '''
+    Primes dividing the product of the factors, with multiplicity
+    '''
+    return [l for n in factors for l, e in factor(n) for _ in range(e)]
+
+def montgomery_model(E):
+    '''
+    Montgomery model of a curve y^2 = x^3 + a2 x^2 + a4 x + a6 through one of
+    its rational 2-torsion points (alpha, 0): x -> (x - alpha) / s, where
+    s = sqrt(3 alpha^2 + 2 a2 alpha + a4) and A = (3 alpha + a2) / s.
+    Returns the curve constant, alpha and s.
+    '''
+    a1, a2, a3, a4, a6 = E.a_invariants()
+    if a1 != 0 or a3 != 0:
+        raise ValueError("Curve must be of the form y^2 = x^3 + a2 x^2 + a4 x + a6")
+    x = polygen(E.base_field())
+    for alpha in (x**3 + a2*x**2 + a4*x + a6).roots(multiplicities=False):
+        beta = 3*alpha**2 + 2*a2*alpha + a4
+        if beta.is_square():
+            s = beta.sqrt()
+            return montgomery_curve(3*alpha + a2, s), alpha, s
+    raise ValueError("Curve has no Montgomery model over its base field")
+
+def to_xz(P, alpha, s):
+    '''
+    XZ coordinates on the Montgomery model of a point of the Weierstrass curve
+    '''
+    if P.is_zero():
+        return (1, 0)
+    return (P.xy()[0] - alpha, s)
+
+def lift_basis(A, xR, xS, xRS):
+    '''
+    Points R, S with x-coordinates xR, xS on a Weierstrass model of the curve
+    y^2 = x^3 + A x^2 + x, or of its quadratic twist when the points lie there
+    (x-only arithmetic does not keep track of the twist). S is negated if
+    needed so that x(R - S) = xRS, which makes e(R, S) well defined.
+    '''
+    F = A.parent()
+    gamma = xR**3 + A*xR**2 + xR
+    if gamma.is_square():
+        gamma = F(1)
+    # gamma y^2 = x^3 + A x^2 + x, with X = gamma x and Y = gamma^2 y
+    E = EllipticCurve(F, [0, A*gamma, 0, gamma**2, 0])
+    R = E.lift_x(gamma*xR)
+    S = E.lift_x(gamma*xS)
+    if (R - S).xy()[0] != gamma*xRS:
+        S = -S
+    return E, R, S
+
+def public_key(curve, points):
+    '''
+    Affine Montgomery coefficient of the curve and x-coordinates of the points
+    '''
+    A, C = montgomery_coefficients(curve)
+    return (A / C, ) + tuple(affine(P) for P in points)
+
+class KummerParameters:
+    def __init__(self, E, PA, QA, PB, QB, factorsA, factorsB):
+        '''
+        x-only view of the public parameters: the Montgomery model of E, the
+        torsion bases with the differences PA - QA and PB - QB needed by the
+        three-point ladder, and the prime factors of the orders A and B
+        '''
+        self.curve, alpha, s = montgomery_model(E)
+        self.PA, self.QA, self.PQA = (to_xz(P, alpha, s) for P in (PA, QA, PA - QA))
+        self.PB, self.QB, self.PQB = (to_xz(P, alpha, s) for P in (PB, QB, PB - QB))
+        self.factorsA = factorsA
+        self.factorsB = factorsB
+        self.bitsA = Integer(prod(factorsA)).nbits()
+        self.bitsB = Integer(prod(factorsB)).nbits()
+
+    def kernel_A(self, k):
+        '''
+        x(PA + k QA) with the three-point ladder
+        '''
+        return ladder3pt(k, self.PA, self.QA, self.PQA, self.curve, bits=self.bitsA)
+
+    def kernel_B(self, k):
+        '''
+        x(PB + k QB) with the three-point ladder
+        '''
+        return ladder3pt(k, self.PB, self.QB, self.PQB, self.curve, bits=self.bitsB)
+
+def kummer_parameters(parameters, E, factorsA, factorsB):
+    '''
+    KummerParameters of a parameter set, computed once and kept on it
+    '''
+    if getattr(parameters, '_kummer', None) is None:
+        parameters._kummer = KummerParameters(E, parameters.PA, parameters.QA, parameters.PB, parameters.QB,
+                                              factorsA, factorsB)
+    return parameters._kummer
@@ -6,7 +6,12 @@
 # Date: Spring 2023
 # ==============================================================================
 
-import math
+import io
+import os
+import json
+import mmap
+import struct
+from functools import cached_property
 from sage.all import *
 from interface import DH_interface, DH_Protocol
 from colorama import Back, Style
@@ -14,13 +19,215 @@ import logging
 import pickle
 from sage.misc.persist import SagePickler
 import threading
+import multiprocessing
 import time
-from sage.schemes.elliptic_curves.hom_composite import EllipticCurveHom_composite
+from sage.schemes.elliptic_curves.hom_composite import EllipticCurveHom_composite, calibrate_velusqrt_crossover, calibrate_isogeny_costs, profile_phase
+import kummer
+import encoding
 
 proof.all(False)
 
+
+def _full_order_tree(x, factors, power, is_identity):
+    '''
+    Given x of order dividing N = prod(l**e for l, e in factors), check that
+    (N/l)*x is not the identity for every l, i.e. that x has order exactly N.
+    The factors are split in halves recursively, each half receiving x
+    multiplied by the product of the other half, so that n factors only need
+    O(n log n) small scalar multiplications instead of n full ones.
+    '''
+    if len(factors) == 1:
+        l, e = factors[0]
+        return not is_identity(power(x, l ** (e - 1)))
+    half = len(factors) // 2
+    left, right = factors[:half], factors[half:]
+    return _full_order_tree(power(x, prod(l ** e for l, e in right)), left, power, is_identity) \
+        and _full_order_tree(power(x, prod(l ** e for l, e in left)), right, power, is_identity)
+
+def point_has_order(P, factors):
+    '''
+    Check that the point P has order exactly prod(l**e for l, e in factors)
+    '''
+    N = prod(l ** e for l, e in factors)
+    return (N * P).is_zero() and _full_order_tree(P, factors, lambda Q, n: n * Q, lambda Q: Q.is_zero())
+
+def element_has_order(z, factors):
+    '''
+    Check that the field element z has multiplicative order exactly prod(l**e for l, e in factors)
+    '''
+    N = prod(l ** e for l, e in factors)
+    return z ** N == 1 and _full_order_tree(z, factors, lambda x, n: x ** n, lambda x: x == 1)
+
+def reduced_tate_pairing(P, Q, n, p):
+    '''
+    Reduced Tate pairing f_{n,P}(Q)^((p^2 - 1)/n) of points of E(Fp2), n | p + 1.
+    The final exponent is split as (p - 1) * (p + 1)/n: the first part is a
+    Frobenius (a conjugation) and an inversion, leaving an exponentiation by
+    (p + 1)/n instead of one of the size of p^2.
+    '''
+    z = P._miller_(Q, n)
+    z = z.frobenius() / z
+    return z ** ((p + 1) // n)
+
+# The first primes, extended on demand by _first_primes
+_primes = []
+
+def _first_primes(k):
+    '''
+    Return the list of the k smallest primes
+    '''
+    if len(_primes) < k:
+        _primes[:] = primes_first_n(max(k, 2 * len(_primes)))
+    return _primes[:k]
+
+def plan_parameters(security_parameter, condition=None, t=None, sample_length=None):
+    '''
+    Find the smallest t (starting from 2*lambda, or from the given t) for which the
+    security condition holds, in a single pass over t.
+
+    The first sample_length(t) primes (the first one squared) are split alternately
+    into A_l and B_l, and n is the first index such that prod(A_l[n:])**2 < prod(B_l).
+    t is too small while condition(lambda, t - n + 1) is true (by default when
+    lambda > t - n + 1). Prefix products of A_l and B_l are kept across the values of
+    t, so prod(A_l[n:]) = A / prefix_A[n] and n is found by binary search.
+
+    Returns t, n and the list of all (t, n) tried.
+    '''
+    if condition is None:
+        condition = lambda lam, bound: lam > bound
+    if sample_length is None:
+        sample_length = lambda t: 2*t - 1
+    if t is None:
+        t = 2*security_parameter
+
+    history = []
+    # prefix_X[k] is the product of the first k elements of X_l
+    prefix_A, prefix_B = [1], [1]
+    while True:
+        primes = _first_primes(sample_length(t))
+        sample = [primes[0] ** 2] + primes[1:]
+        A_l, B_l = sample[::2], sample[1::2]
+        for l in A_l[len(prefix_A) - 1:]:
+            prefix_A.append(prefix_A[-1] * l)
+        for l in B_l[len(prefix_B) - 1:]:
+            prefix_B.append(prefix_B[-1] * l)
+        A, B = prefix_A[len(A_l)], prefix_B[len(B_l)]
+
+        # B <= (A / prefix_A[n])**2 holds for all n below the one we look for
+        lo, hi = 0, len(A_l)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if B * prefix_A[mid] ** 2 <= A ** 2:
+                lo = mid + 1
+            else:
+                hi = mid
+        n = lo
+
+        history.append((t, n))
+        if not condition(security_parameter, t - n + 1):
+            return t, n, history
+        print(f"retrying with t={t+1}")
+        t += 1
+
+def _close_to_sqrt(n, p):
+    '''
+    sqrt(p) / 10^3 <= n <= 10^5 sqrt(p), with integers only (math.sqrt overflows
+    for primes of more than 1024 bits)
+    '''
+    n, p = Integer(n), Integer(p)
+    return p <= n**2 * 10**6 and n**2 <= p * 10**10
+
+def _is_msidh_prime(p):
+    return mod(p, 4) == 3 and is_prime(p)
+
+def find_cofactor(N, start=1, window=4096, sieve_bound=2**18, processes=None, progress=None):
+    '''
+    Return the smallest f >= start such that p = N*f - 1 is a prime with p = 3 mod 4.
+    If given, progress is called with the start of the next window every time
+    a window holds no such prime, so an interrupted search can be resumed.
+
+    The candidates are taken in windows of consecutive f. In each window, the f for
+    which N*f - 1 is divisible by a prime q < sieve_bound (i.e. f = 1/N mod q) or
+    N*f - 1 != 3 mod 4 are sieved out before any primality test. The survivors are
+    tested in parallel on a pool of processes and the first prime in increasing
+    order of f is returned, so the result does not depend on the number of processes.
+    '''
+    N = Integer(N)
+    # primes dividing N never divide N*f - 1
+    roots = [(q, inverse_mod(N % q, q)) for q in prime_range(sieve_bound) if N % q != 0]
+    with multiprocessing.get_context('fork').Pool(processes) as pool:
+        f0 = Integer(start)
+        while True:
+            alive = [True] * window
+            for q, r in roots:
+                for i in range((r - f0) % q, window, q):
+                    alive[i] = False
+            candidates = [f0 + i for i in range(window) if alive[i] and (N * (f0 + i)) % 4 == 0]
+            print(f"f in [{f0}, {f0 + window}): {len(candidates)} candidates left after sieving")
+            tests = pool.imap(_is_msidh_prime, (N * f - 1 for f in candidates), chunksize=4)
+            for f, prime in zip(candidates, tests):
+                if prime:
+                    return f
+            f0 += window
+            if progress is not None:
+                progress(f0)
+
+
+class GenerationCheckpoint:
+    def __init__(self, path, key):
+        '''
+        Results of the completed stages of a parameter generation, saved to
+        path (atomically, after every stage) as JSON. key describes the
+        arguments of the generation: a checkpoint saved with another key is
+        ignored and overwritten.
+        '''
+        self.path = path
+        self.key = key
+        self.stages = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved["key"] == key:
+                self.stages = saved["stages"]
+                print(f"{Back.MAGENTA}Resuming from {path}: {', '.join(self.stages) or 'no stage'} done{Style.RESET_ALL}")
+
+    def save(self, stage, value):
+        self.stages[stage] = value
+        self._write()
+
+    def discard(self, stage):
+        '''
+        Forget a stage, so that the next run computes it again
+        '''
+        if self.stages.pop(stage, None) is not None:
+            self._write()
+
+    def _write(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"key": self.key, "stages": self.stages}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def stage(self, stage, compute):
+        '''
+        Result of the stage, computed with compute() and saved unless a
+        previous run completed it
+        '''
+        if stage not in self.stages:
+            self.save(stage, compute())
+        else:
+            print(f"{Back.MAGENTA}Stage {stage} loaded from the checkpoint{Style.RESET_ALL}")
+        return self.stages[stage]
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
 class MSIDH_Parameters:
-    def __init__(self, f, p, E0, A, B, Af, Bf, G, validate=False):
+    def __init__(self, f, p, E0, A, B, Af, Bf, G, validate=False, basis='random'):
         '''
         Public parameters:
             f: Cofactor for p
@@ -41,6 +248,11 @@ class MSIDH_Parameters:
             the generated points are on the curve
             the generated points are torsion points of degree A and B
             the generated points are distinct
+
+        Basis generation (basis=):
+            'random': sample random points until they generate E0[p+1]
+            'deterministic': enumerate x-coordinates, check the orders with product
+                trees and the independence with a single Weil pairing of order p+1
         '''
 
         self.f = f
@@ -53,9 +265,39 @@ class MSIDH_Parameters:
         self.G = G
 
         # Calculate the points PA, QA, PB, QB
+        gens = self._find_basis(basis)
+        self.PA, self.QA = ( B * G * f for G in gens)
+        self.PB, self.QB = ( A * G * f for G in gens)
 
-        factorization = factor(p+1)
+        # Reference values of the public key validation, stored with the parameters
+        self._precompute_pairings()
+
+        print(f"{Back.BLUE}==== Generated M-SIDH parameters [{self.__class__.__name__}] ==== {Style.RESET_ALL}")
+
+        # Verify the parameters
+        if validate and not self.verify_parameters():
+            raise Exception("Invalid parameters")
+        
+
+    def _find_basis(self, basis):
+        '''
+        Basis (P, Q) of E0[p+1], found with the given basis generation
+        '''
+        factorization = factor(self.p + 1)
         print("Factorization of p+1: ", factorization)
+        if basis == 'random':
+            return self._random_basis(factorization)
+        if basis == 'deterministic':
+            return self._deterministic_basis(factorization)
+        raise ValueError(f"Unknown basis generation: {basis}")
+
+    def _random_basis(self, factorization):
+        '''
+        Sample random points until they form a basis of E0[p+1]
+        '''
+        p = self.p
+        E0 = self.E0
+
         # Sample a random point P on the curve
         P = E0.random_point()
 
@@ -133,23 +375,87 @@ class MSIDH_Parameters:
             
 
         # 13. If the check succeeds, then (P, Q) is a basis of E0[p+1] = <P, Q>
-        print(f"Generator Q found")    
-        gens = [P, Q]
-        self.PA, self.QA = ( B * G * f for G in gens)
-        self.PB, self.QB = ( A * G * f for G in gens)
+        print(f"Generator Q found")
 
-        print(f"{Back.BLUE}==== Generated M-SIDH parameters [{self.__class__.__name__}] ==== {Style.RESET_ALL}")
+        return P, Q
 
-        # Verify the parameters
-        if validate and not self.verify_parameters():
-            raise Exception("Invalid parameters")
-        
+    def _x_only_points(self):
+        '''
+        Enumerate the points of E0 with x-coordinate x0, x0 + 1, x0 + 2, ... where
+        x0 is the generator of Fp2, in a deterministic order
+        '''
+        E0 = self.E0
+        x = E0.base_field().gen()
+        while True:
+            if E0.is_x_coord(x):
+                yield E0.lift_x(x)
+            x += 1
+
+    def _deterministic_basis(self, factorization):
+        '''
+        Find a basis of E0[p+1] among the points returned by _x_only_points.
+        The order of each candidate is checked with a product tree over the
+        factorization of p+1, and the independence of P and Q with a single
+        Weil pairing: (P, Q) is a basis iff e(P, Q) has order p+1.
+        '''
+        factors = list(factorization)
+        candidates = (R for R in self._x_only_points() if point_has_order(R, factors))
+        P = next(candidates)
+        print(f"Generator P found")
+        for Q in candidates:
+            if element_has_order(P.weil_pairing(Q, self.p + 1), factors):
+                print(f"Generator Q found")
+                return P, Q
+
+    def _precompute_pairings(self, pairing='weil'):
+        '''
+        Compute (and cache) the reference values of the public key validation
+        of both parties with the Weil or the reduced Tate pairing
+        '''
+        if pairing == 'tate':
+            return self.tate_A, self.tate_B
+        return self.pairing_A, self.pairing_B
+
+    @cached_property
+    def pairing_A(self):
+        '''
+        e_A(PA, QA)^B, which e_A(R, S) must match for a public key (E, R, S) of B
+        '''
+        return self.PA.weil_pairing(self.QA, self.A) ** self.B
+
+    @cached_property
+    def pairing_B(self):
+        '''
+        e_B(PB, QB)^A, which e_B(R, S) must match for a public key (E, R, S) of A
+        '''
+        return self.PB.weil_pairing(self.QB, self.B) ** self.A
+
+    @cached_property
+    def tate_A(self):
+        '''
+        t_A(PA, QA)^B, the reference of the public key validation with the reduced Tate pairing
+        '''
+        return reduced_tate_pairing(self.PA, self.QA, self.A, self.p) ** self.B
+
+    @cached_property
+    def tate_B(self):
+        '''
+        t_B(PB, QB)^A, the reference of the public key validation with the reduced Tate pairing
+        '''
+        return reduced_tate_pairing(self.PB, self.QB, self.B, self.p) ** self.A
 
     def __str__(self):
         return f"f: {self.f}\np: {self.p}\nA: {self.A}\nB: {self.B}\nE0: {self.E0}\nPA: {self.PA}\nQA: {self.QA}\nPB: {self.PB}\nQB: {self.QB}"
 
 
-    def verify_parameters(self):
+    def verify_parameters(self, fast=False):
+        '''
+        Check the parameters (see __init__). With fast, the checks use what is
+        known about the parameters instead of generic algorithms, see
+        _verify_parameters_fast.
+        '''
+        if fast:
+            return self._verify_parameters_fast()
 
         p = self.p
         A = self.A
@@ -184,12 +490,12 @@ class MSIDH_Parameters:
             return False
         
         # A ~ B ~ sqrt(p)
-        valid = math.sqrt(p)*10e-4 <= A <= math.sqrt(p) * 10e4 and math.sqrt(p) * 10e-4 <= B <= math.sqrt(p) * 10e+4
+        valid = _close_to_sqrt(A, p) and _close_to_sqrt(B, p)
         print(f"A ~ B ~ sqrt(p): {Back.LIGHTGREEN_EX if valid else Back.RED}{valid}{Style.RESET_ALL}")
         if not valid:
             print(f"A or B is not close to sqrt(p)")
             print(f"{Back.RED}==== SIDH parameters are not valid ==== {Style.RESET_ALL}")
-            print(A, B, math.sqrt(p))
+            print(A, B, p)
             return False
         
         # A, B coprime
@@ -256,10 +562,84 @@ class MSIDH_Parameters:
         
         print(f"{Back.LIGHTGREEN_EX}==== SIDH parameters are valid ==== {Style.RESET_ALL}")
         return True
-    
+
+    def _verify_parameters_fast(self):
+        '''
+        Same checks as verify_parameters, in seconds for large parameters:
+        - E0 is supersingular because j(E0) = 1728 and p = 3 mod 4, the generic
+          test is only used for other curves
+        - p is a probable prime (BPSW) instead of a proven one
+        - the orders of the points are checked at once for every prime of the
+          known factorizations Af, Bf with product trees, instead of PA.order()
+        - (PA, QA) is a basis of E0[A] iff e_A(PA, QA) has order A, which also
+          implies that the points are distinct and not trivial (same for B)
+        - the stored reference pairings are checked against the points
+        The checks rely on Af and Bf, so they are first checked to multiply to A
+        and B (pickled parameters store them separately):
+
+            sage: import msidh
+            sage: params = msidh.MSIDH_Parameters.__new__(msidh.MSIDH_Parameters)
+            sage: params.p, params.f, params.A, params.B = 419, 1, 4*5*7, 3
+            sage: params.Af, params.Bf = [4, 5], [3]
+            sage: params.E0 = EllipticCurve(GF(419), [1, 0])
+            sage: params._verify_parameters_fast()
+            ...
+            A = prod(Af): ...False...
+            ...
+            False
+        '''
+        p, A, B, f, curve = self.p, self.A, self.B, self.f, self.E0
+        factorsA = [(l, e) for n in self.Af for l, e in factor(n)]
+        factorsB = [(l, e) for n in self.Bf for l, e in factor(n)]
+
+        print(f"{Back.LIGHTBLUE_EX}==== Verifying M-SIDH parameters (fast) [{self.__class__.__name__}] ==== {Style.RESET_ALL}")
+
+        def check(label, valid):
+            print(f"{label}: {Back.LIGHTGREEN_EX if valid else Back.RED}{valid}{Style.RESET_ALL}")
+            if not valid:
+                print(f"{Back.RED}==== SIDH parameters are not valid ==== {Style.RESET_ALL}")
+            return valid
+
+        if not (check("A = prod(Af)", A == prod(self.Af))
+                and check("B = prod(Bf)", B == prod(self.Bf))
+                and check("p = A*B*f - 1", p == A*B*f - 1)
+                and check("p is a probable prime", is_pseudoprime(p))
+                and check("A ~ B ~ sqrt(p)", _close_to_sqrt(A, p) and _close_to_sqrt(B, p))
+                and check("A, B coprime", gcd(A, B) == 1)):
+            return False
+
+        if curve.j_invariant() == 1728 and p % 4 == 3:
+            supersingular = True
+        else:
+            supersingular = curve.is_supersingular(proof=True)
+        if not check("Curve is supersingular", supersingular):
+            return False
+
+        points = {"PA": self.PA, "QA": self.QA, "PB": self.PB, "QB": self.QB}
+        for name, P in points.items():
+            if not check(f"{name} is on the curve", not P.is_zero() and curve.is_on_curve(*P.xy())):
+                return False
+        for name, P in points.items():
+            factors = factorsA if name.endswith("A") else factorsB
+            if not check(f"{name} has order {name[-1]}", point_has_order(P, factors)):
+                return False
+
+        eA = self.PA.weil_pairing(self.QA, A)
+        eB = self.PB.weil_pairing(self.QB, B)
+        if not (check("PA, QA is a basis of E0[A]", element_has_order(eA, factorsA))
+                and check("PB, QB is a basis of E0[B]", element_has_order(eB, factorsB))
+                and check("Reference pairings match", eA ** B == self.pairing_A and eB ** A == self.pairing_B)):
+            return False
+
+        print(f"{Back.LIGHTGREEN_EX}==== SIDH parameters are valid ==== {Style.RESET_ALL}")
+        return True
+
 
 class MSIDHp128(MSIDH_Parameters):
-    def __init__(self):
+    name = "MSIDHp128"
+    security_parameter = 128
+
+    def __init__(self, basis='random'):
         f =  10
         t = 572
         pari.allocatemem(1<<32)
@@ -290,24 +670,36 @@ class MSIDHp128(MSIDH_Parameters):
         E0 = EllipticCurve(F, [1,0])
         print(f"{Back.LIGHTMAGENTA_EX}DONE{Style.RESET_ALL}")
         logging.getLogger().setLevel(logging.WARNING)
-        super().__init__(f, p, E0, A, B, A_l, B_l, F)
+        super().__init__(f, p, E0, A, B, A_l, B_l, F, basis=basis)
 
 
 class MSIDHpArbitrary(MSIDH_Parameters):
-    def __init__(self, security_parameter, force_t = None):
+    def __init__(self, security_parameter, force_t = None, basis='random', processes=None, checkpoint=None, validate=False):
+        '''
+        checkpoint: if set, directory where the result of every generation stage
+            (prime planning, cofactor search, field and curve, torsion basis,
+            verification) is saved once completed. A generation with the same
+            security parameter, force_t and basis resumes after the last
+            completed stage.
+        '''
         self.security_parameter = security_parameter
-        t = 2*security_parameter
-        if force_t is not None:
-            t = force_t
-            
+        self.name = f"MSIDH_AES-{security_parameter}"
+        self.checkpoint = None
+        if checkpoint is not None:
+            os.makedirs(checkpoint, exist_ok=True)
+            self.checkpoint = GenerationCheckpoint(os.path.join(checkpoint, f"{self.name}.checkpoint.json"),
+                                                   {"security_parameter": int(security_parameter),
+                                                    "force_t": None if force_t is None else int(force_t),
+                                                    "basis": basis})
         pari.allocatemem(1<<32)
         print(f"{Back.LIGHTMAGENTA_EX}GENERATING THE SETTINGS...{Style.RESET_ALL}")
-        # Get the lambda smallest primes
-        primes = Primes()
-        primes_list = [primes.unrank(0) ** 2]
-        # collect the primes
-        for i in range(1, 2*t -1):
-            primes_list.append(primes.unrank(i))
+        # Find the smallest t >= 2*lambda (or force_t) satisfying the security condition
+        t, n = self._stage("plan", lambda: [int(x) for x in plan_parameters(security_parameter, t=force_t)[:2]])
+        print(f"t = {t}, n = {n}")
+
+        # Get the 2t - 1 smallest primes, the first one squared
+        primes_list = _first_primes(2*t - 1)
+        primes_list[0] = primes_list[0] ** 2
         # A_l = elements of even index in list
         # B_l = elements of odd index in list
         A_l = primes_list[::2]
@@ -317,34 +709,66 @@ class MSIDHpArbitrary(MSIDH_Parameters):
         A = prod(A_l)
         B = prod(B_l)
 
-        # Now we have to find largest n such that prod B <= A_l[n:] ** 2
-        n = 0
-        while B <= prod(A_l[n:]) ** 2:
-            n += 1
-
-        if security_parameter > (t - n + 1):
-            # We have to restart with a larger t
-            print(f"retrying with t={t+1}")
-            self.__init__(security_parameter, force_t=t+1)
-            return
-        
-        # Calculate p
-        f = 1
+        # Calculate p, the search restarts from the last window checkpointed
+        start = self.checkpoint.stages.get("cofactor_start", 1) if self.checkpoint else 1
+        progress = (lambda f0: self.checkpoint.save("cofactor_start", int(f0))) if self.checkpoint else None
+        f = Integer(self._stage("cofactor", lambda: int(find_cofactor(A * B, start=start, processes=processes,
+                                                                      progress=progress))))
         p = A * B * f - 1
-        while not (is_prime(p) and mod(p, 4) == 3):
-            f += 1
-            p = A * B * f - 1
 
         assert mod(p, 4) == 3
         print(f"p = {p}")
-        F = FiniteField((p, 2), name='x')
-        print (f"{Back.LIGHTMAGENTA_EX}GENERATING THE CURVE...{Style.RESET_ALL}")
-        (a, ) = F._first_ngens(1)
-        print(f"a = {F(1)}")
-        E0 = EllipticCurve(j=F(1728))
+        F, E0 = self._build_curve(p)
         print(f"{Back.LIGHTMAGENTA_EX}DONE{Style.RESET_ALL}")
-        self.name = f"MSIDH_AES-{security_parameter}"
-        super().__init__(f, p, E0, A, B, A_l, B_l, F)
+        super().__init__(f, p, E0, A, B, A_l, B_l, F, basis=basis)
+
+        if validate:
+            self._verify_checkpointed()
+
+    def _verify_checkpointed(self):
+        '''
+        Fast verification of the parameters. Only a successful verification is
+        checkpointed: on failure the basis is dropped from the checkpoint, so
+        that a rerun searches it again instead of reusing the invalid one.
+        '''
+        if self.checkpoint is not None and self.checkpoint.stages.get("verification"):
+            print(f"{Back.MAGENTA}Stage verification loaded from the checkpoint{Style.RESET_ALL}")
+            return
+        if not self.verify_parameters(fast=True):
+            if self.checkpoint is not None:
+                self.checkpoint.discard("verification")
+                self.checkpoint.discard("basis")
+            raise Exception("Invalid parameters")
+        if self.checkpoint is not None:
+            self.checkpoint.save("verification", True)
+
+    def _stage(self, stage, compute):
+        if self.checkpoint is None:
+            return compute()
+        return self.checkpoint.stage(stage, compute)
+
+    def _build_curve(self, p):
+        '''
+        Fp2 and E0: j = 1728. Once checkpointed, the modulus of Fp2 is reused
+        and p is not proven prime again.
+        '''
+        if self.checkpoint is not None and "field" in self.checkpoint.stages:
+            print(f"{Back.MAGENTA}Stage field loaded from the checkpoint{Style.RESET_ALL}")
+            modulus = self.checkpoint.stages["field"]["modulus"]
+            F = FiniteField((p, 2), name="x", modulus=PolynomialRing(GF(p, proof=False), "x")(modulus + [1]), proof=False)
+        else:
+            F = FiniteField((p, 2), name='x')
+            if self.checkpoint is not None:
+                self.checkpoint.save("field", {"modulus": [int(c) for c in F.modulus().list()[:2]]})
+        print (f"{Back.LIGHTMAGENTA_EX}GENERATING THE CURVE...{Style.RESET_ALL}")
+        return F, EllipticCurve(j=F(1728))
+
+    def _find_basis(self, basis):
+        F = self.G
+        coordinates = self._stage("basis", lambda: [int(c) for P in super(MSIDHpArbitrary, self)._find_basis(basis)
+                                                     for z in P.xy() for c in _fp2_coordinates(z)])
+        points = [F(coordinates[i:i+2]) for i in range(0, 8, 2)]
+        return self.E0(points[0:2]), self.E0(points[2:4])
 
 
 def mewtwo(b, factors):
@@ -370,9 +794,338 @@ def mewtwo(b, factors):
         return res
     
 
+# ==============================================================================
+# Compact binary format of the parameters
+#
+#   magic | version (u16) | name | security parameter | p | f | Af | Bf
+#         | modulus of Fp2 | a-invariants of E0 | PA, QA, PB, QB
+#         | e_A(PA, QA)^B, e_B(PB, QB)^A (since version 2)
+#
+# Integers are stored as their u32 byte length followed by their big-endian bytes,
+# lists as their u32 length followed by their elements. Fp2 = Fp[x]/(x^2 + c1 x + c0)
+# is stored as [c0, c1] and its elements by their two coordinates on (1, x).
+# ==============================================================================
+
+PARAMETERS_MAGIC = b"MSIDH\x00"
+PARAMETERS_VERSION = 2
+PARAMETERS_EXTENSION = ".msidh"
+
+def _write_bytes(out, data):
+    out.write(struct.pack(">I", len(data)))
+    out.write(data)
+
+def _read_bytes(data):
+    (length, ) = struct.unpack(">I", data.read(4))
+    return data.read(length)
+
+def _write_int(out, n):
+    n = int(n)
+    _write_bytes(out, n.to_bytes((n.bit_length() + 7) // 8, "big"))
+
+def _read_int(data):
+    return Integer(int.from_bytes(_read_bytes(data), "big"))
+
+def _write_ints(out, ns):
+    out.write(struct.pack(">I", len(ns)))
+    for n in ns:
+        _write_int(out, n)
+
+def _read_ints(data):
+    (count, ) = struct.unpack(">I", data.read(4))
+    return [_read_int(data) for _ in range(count)]
+
+def _fp2_coordinates(z):
+    c = z.polynomial().list()
+    return c + [0] * (2 - len(c))
+
+def save_parameters(settings, path):
+    '''
+    Write the parameters to path in the compact binary format
+    '''
+    F = settings.G
+    out = io.BytesIO()
+    out.write(PARAMETERS_MAGIC)
+    out.write(struct.pack(">H", PARAMETERS_VERSION))
+    _write_bytes(out, settings.name.encode())
+    _write_int(out, getattr(settings, "security_parameter", 0))
+    _write_int(out, settings.p)
+    _write_int(out, settings.f)
+    _write_ints(out, settings.Af)
+    _write_ints(out, settings.Bf)
+    _write_ints(out, F.modulus().list()[:2])
+    _write_ints(out, [c for a in settings.E0.a_invariants() for c in _fp2_coordinates(F(a))])
+    _write_ints(out, [c for P in (settings.PA, settings.QA, settings.PB, settings.QB)
+                        for z in P.xy() for c in _fp2_coordinates(z)])
+    _write_ints(out, _fp2_coordinates(settings.pairing_A) + _fp2_coordinates(settings.pairing_B))
+
+    # Write next to the target and rename, readers never see a partial file
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(out.getvalue())
+    os.replace(tmp, path)
+
+def _read_header(data):
+    '''
+    Check the magic and version of a parameter file, returns its version, name
+    and security parameter
+    '''
+    if data.read(len(PARAMETERS_MAGIC)) != PARAMETERS_MAGIC:
+        raise ValueError("Not an M-SIDH parameter file")
+    (version, ) = struct.unpack(">H", data.read(2))
+    if not 1 <= version <= PARAMETERS_VERSION:
+        raise ValueError(f"Unsupported M-SIDH parameter file version: {version}")
+    return version, _read_bytes(data).decode(), _read_int(data)
+
+def _map_file(path):
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def load_parameters(path, check_pairings=False):
+    '''
+    Read parameters written by save_parameters. The file is memory-mapped, so
+    processes loading the same file share its pages.
+    '''
+    return MSIDH_LazyParameters(_map_file(path), check_pairings)
+
+class MSIDH_LazyParameters(MSIDH_Parameters):
+    def __init__(self, data, check_pairings=False):
+        '''
+        Parameters decoded from the compact binary format, given as bytes or
+        as a memory-mapped file. Only the integers are read here, the field, the
+        curve and the torsion basis are decoded and built on first access (no
+        irreducible polynomial search nor point validation).
+
+        The reference pairings stored in the file are only checked to have the
+        right order, which catches a corrupted file but not a value of the right
+        order that does not belong to the basis. check_pairings: also compare
+        them against the pairings recomputed from the basis (two Weil pairings,
+        the cost the stored values are meant to save).
+        '''
+        self.check_pairings = check_pairings
+        if not isinstance(data, mmap.mmap):
+            data = io.BytesIO(data)
+        data.seek(0)
+        self._version, self.name, self.security_parameter = _read_header(data)
+        self.p = _read_int(data)
+        self.f = _read_int(data)
+        self.Af = _read_ints(data)
+        self.Bf = _read_ints(data)
+        self.A = prod(self.Af)
+        self.B = prod(self.Bf)
+        self._data = data
+        self._offset = data.tell()
+
+    @cached_property
+    def _coordinates(self):
+        '''
+        Modulus of Fp2, a-invariants of E0, coordinates of PA, QA, PB, QB and
+        of the reference pairings (empty before version 2)
+        '''
+        self._data.seek(self._offset)
+        coordinates = [_read_ints(self._data) for _ in range(3)]
+        coordinates.append(_read_ints(self._data) if self._version >= 2 else [])
+        return coordinates
+
+    def _stored_pairing(self, i, factors):
+        '''
+        Reference pairing i of the file, checked to have order prod(factors)
+        (A or B), or None for files written before version 2. Only the order is
+        checked unless check_pairings is set.
+        '''
+        coordinates = self._coordinates[3]
+        if not coordinates:
+            return None
+        z = self.G(coordinates[2*i:2*i+2])
+        order = [(l, e) for n in factors for l, e in factor(n)]
+        if not element_has_order(z, order):
+            raise ValueError(f"Invalid reference pairing in the parameters {self.name}")
+        return z
+
+    def _fp2(self, coordinates):
+        return [self.G(coordinates[i:i+2]) for i in range(0, len(coordinates), 2)]
+
+    def _point(self, i):
+        x, y = self._fp2(self._coordinates[2][4*i:4*i+4])
+        return self.E0.point([x, y, 1], check=False)
+
+    @cached_property
+    def G(self):
+        modulus = PolynomialRing(GF(self.p), "x")(self._coordinates[0] + [1])
+        return FiniteField((self.p, 2), name="x", modulus=modulus, proof=False)
+
+    @cached_property
+    def E0(self):
+        return EllipticCurve(self.G, self._fp2(self._coordinates[1]))
+
+    def _checked_pairing(self, z, reference):
+        '''
+        Stored pairing z, compared against reference(self) if check_pairings is
+        set, or reference(self) if the file has none
+        '''
+        if z is None:
+            return reference(self)
+        if self.check_pairings and z != reference(self):
+            raise ValueError(f"Reference pairing does not match the basis in the parameters {self.name}")
+        return z
+
+    @cached_property
+    def pairing_A(self):
+        return self._checked_pairing(self._stored_pairing(0, self.Af), MSIDH_Parameters.pairing_A.func)
+
+    @cached_property
+    def pairing_B(self):
+        return self._checked_pairing(self._stored_pairing(1, self.Bf), MSIDH_Parameters.pairing_B.func)
+
+    @cached_property
+    def PA(self):
+        return self._point(0)
+
+    @cached_property
+    def QA(self):
+        return self._point(1)
+
+    @cached_property
+    def PB(self):
+        return self._point(2)
+
+    @cached_property
+    def QB(self):
+        return self._point(3)
+
+class MSIDH_ParameterStore:
+    def __init__(self, directory="./models"):
+        '''
+        Memory-mapped directory of parameter files in the binary format, indexed
+        by name and by security level. Only the headers are read when the store
+        is opened, the parameters are decoded on first access and their field,
+        curve and points on first use (see MSIDH_LazyParameters). A store opened
+        before forking workers is shared by all of them.
+
+        Two files holding parameters of the same name are an error. Parameter
+        sets sharing a security level (MSIDHp128 and MSIDH_AES-128) are only
+        available by name.
+        '''
+        self.directory = directory
+        self._files = {}
+        self._maps = {}
+        self._levels = {}
+        self._parameters = {}
+        try:
+            for filename in sorted(os.listdir(directory)):
+                if not filename.endswith(PARAMETERS_EXTENSION):
+                    continue
+                data = _map_file(os.path.join(directory, filename))
+                try:
+                    _, name, level = _read_header(data)
+                    if name in self._files:
+                        raise ValueError(f"{self._files[name]} and {filename} both hold the parameters {name}")
+                except ValueError:
+                    data.close()
+                    raise
+                self._files[name] = filename
+                self._maps[name] = data
+                self._levels.setdefault(level, []).append(name)
+        except ValueError:
+            self.close()
+            raise
+
+    def levels(self):
+        return sorted(self._levels)
+
+    def names(self):
+        return sorted(self._files)
+
+    def _name(self, key):
+        '''
+        Name of the parameters given by their name or security level
+        '''
+        if key in self._files:
+            return key
+        names = self._levels.get(key)
+        if not names:
+            raise KeyError(f"No parameters for security level {key} in {self.directory}")
+        if len(names) > 1:
+            raise KeyError(f"Security level {key} is shared by {', '.join(names)} in {self.directory}, "
+                           "use the name of the parameters")
+        return names[0]
+
+    def filename(self, key):
+        return self._files[self._name(key)]
+
+    def __contains__(self, key):
+        try:
+            self._name(key)
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, key):
+        name = self._name(key)
+        if name not in self._parameters:
+            self._parameters[name] = MSIDH_LazyParameters(self._maps[name])
+        return self._parameters[name]
+
+    def close(self):
+        self._parameters.clear()
+        for data in self._maps.values():
+            data.close()
+        self._maps.clear()
+
+def convert_pickled_parameters(directory="./models"):
+    '''
+    Write every pickled parameter set of the directory in the binary format,
+    next to the pickle. Returns the paths written.
+    '''
+    written = []
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(".pickle"):
+            continue
+        with open(os.path.join(directory, filename), "rb") as f:
+            settings = pickle.load(f)
+        path = os.path.join(directory, filename[:-len(".pickle")] + PARAMETERS_EXTENSION)
+        save_parameters(settings, path)
+        print(f"{filename} -> {path}")
+        written.append(path)
+    return written
+
+
 class MSIDH_Party_A(DH_interface):
-    def __init__(self, parameters):
+    def __init__(self, parameters, decomposition='product_tree', processes=None, backend='weierstrass', pairing='weil'):
+        '''
+        decomposition: how the kernel is split into prime steps (see hom_composite)
+        processes: if set, the images of the torsion basis are evaluated in that
+            many worker processes once the isogeny is built, instead of being
+            pushed through each step during its construction
+        backend: 'weierstrass' for Sage points and isogenies, 'montgomery' for
+            x-only arithmetic on the Montgomery model of E0 (see kummer.py). The
+            public keys of the two backends are not interchangeable.
+        pairing: 'weil' or 'tate', the pairing used to validate the public key
+            of the other party (see validate_public_key)
+        '''
+        if backend not in ('weierstrass', 'montgomery'):
+            raise ValueError(f"Unknown backend: {backend}")
+        if pairing not in ('weil', 'tate'):
+            raise ValueError(f"Unknown pairing: {pairing}")
+        # t_A(P, Q) = e_A(P, Q)^(-(p+1)/A), the Tate check is only as strong as the
+        # Weil one when (p+1)/A = B*f is invertible modulo A
+        if pairing == 'tate' and gcd(parameters.A, parameters.f) != 1:
+            print(f"{Back.YELLOW}gcd(A, f) != 1, validating with the Weil pairing{Style.RESET_ALL}")
+            pairing = 'weil'
         self.parameters = parameters
+        self.decomposition = decomposition
+        self.processes = processes
+        self.backend = backend
+        self.pairing = pairing
+
+    def kummer_parameters(self):
+        pr = self.parameters
+        return kummer.kummer_parameters(pr, pr.E0, kummer.prime_factors(pr.Af), kummer.prime_factors(pr.Bf))
+
+    def encode_public_key(self, public_key):
+        return encoding.encode_public_key(public_key, self.backend)
+
+    def decode_public_key(self, data):
+        return encoding.decode_public_key(data, self.parameters.E0.base_field(), self.backend)
 
     def get_public_parameters(self):
         return self.parameters
@@ -388,28 +1141,106 @@ class MSIDH_Party_A(DH_interface):
 
     def compute_public_key(self, private_key):
         pr = self.parameters
-        KA = pr.PA + private_key[1] * pr.QA
-        phiA = EllipticCurveHom_composite(pr.E0, KA, kernel_order=pr.A)
-        return ( phiA.codomain(), private_key[0] * phiA(pr.PB), private_key[0] * phiA(pr.QB) )
+        if self.backend == 'montgomery':
+            kp = self.kummer_parameters()
+            with profile_phase('public_key.kernel'):
+                K = kp.kernel_A(private_key[1])
+            with profile_phase('public_key.isogeny'):
+                curve, images = kummer.isogeny(K, kp.factorsA, kp.curve, [kp.PB, kp.QB, kp.PQB])
+            with profile_phase('public_key.mask'):
+                return kummer.public_key(curve, [kummer.ladder(private_key[0], P, curve) for P in images])
+
+        with profile_phase('public_key.kernel'):
+            KA = pr.PA + private_key[1] * pr.QA
+        with profile_phase('public_key.isogeny'):
+            if self.processes:
+                phiA = EllipticCurveHom_composite(pr.E0, KA, kernel_order=pr.A, decomposition=self.decomposition)
+                imPB, imQB = phiA.eval_parallel([pr.PB, pr.QB], self.processes)
+            else:
+                phiA = EllipticCurveHom_composite(pr.E0, KA, kernel_order=pr.A, decomposition=self.decomposition, points=[pr.PB, pr.QB])
+                imPB, imQB = phiA.pushed_points()
+        with profile_phase('public_key.mask'):
+            return ( phiA.codomain(), private_key[0] * imPB, private_key[0] * imQB )
+
+    def validate_public_key(self, other_public_key):
+        '''
+        Check that the public key (E, R, S) of B satisfies e_A(R, S) = e_A(PA, QA)^B,
+        with the Weil pairing or with the reduced Tate pairing (one Miller loop
+        instead of two). Both sides of the check pair points that only the key
+        determines, so only the reference values can be precomputed.
+        '''
+        pr = self.parameters
+        if self.backend == 'montgomery':
+            _, R, S = kummer.lift_basis(*other_public_key)
+        else:
+            R, S = other_public_key[1], other_public_key[2]
+        if self.pairing == 'tate':
+            return reduced_tate_pairing(R, S, pr.A, pr.p) == pr.tate_A
+        return R.weil_pairing(S, pr.A) == pr.pairing_A
 
     def compute_shared_secret(self, private_key, other_public_key):
-        # Check the Weil pairing values
-        # eA(Ra, Sa) = eA(PA, QA) ** B
-        # Uses sage's implementation of the Weil pairing
+        with profile_phase('shared_secret.validation'):
+            assert self.validate_public_key(other_public_key), "Pairing values do not match"
+        return self._shared_secret(private_key, other_public_key)
+
+    def _shared_secret(self, private_key, other_public_key):
+        '''
+        Shared secret with a public key that has already been validated
+        '''
         pr = self.parameters
-        Ra = other_public_key[1]
-        Sa = other_public_key[2]
-        p1 = Ra.weil_pairing(Sa, pr.A)
-        p2 = pr.PA.weil_pairing(pr.QA, pr.A) ** pr.B
-        assert p1 == p2, "Weil pairing values do not match"
-
-        LA = other_public_key[1] + private_key[1] * other_public_key[2]
-        psiA = EllipticCurveHom_composite(other_public_key[0], LA, kernel_order=pr.A)
+        if self.backend == 'montgomery':
+            kp = self.kummer_parameters()
+            A, xR, xS, xRS = other_public_key
+            curve = kummer.montgomery_curve(A)
+            with profile_phase('shared_secret.kernel'):
+                K = kummer.ladder3pt(private_key[1], (xR, 1), (xS, 1), (xRS, 1), curve, bits=kp.bitsA)
+            with profile_phase('shared_secret.isogeny'):
+                curve, _ = kummer.isogeny(K, kp.factorsA, curve)
+            return kummer.j_invariant(curve)
+
+        with profile_phase('shared_secret.kernel'):
+            LA = other_public_key[1] + private_key[1] * other_public_key[2]
+        with profile_phase('shared_secret.isogeny'):
+            psiA = EllipticCurveHom_composite(other_public_key[0], LA, kernel_order=pr.A, decomposition=self.decomposition)
         return psiA.codomain().j_invariant()
     
 class MSIDH_Party_B(DH_interface):
-    def __init__(self, parameters):
+    def __init__(self, parameters, decomposition='product_tree', processes=None, backend='weierstrass', pairing='weil'):
+        '''
+        decomposition: how the kernel is split into prime steps (see hom_composite)
+        processes: if set, the images of the torsion basis are evaluated in that
+            many worker processes once the isogeny is built, instead of being
+            pushed through each step during its construction
+        backend: 'weierstrass' for Sage points and isogenies, 'montgomery' for
+            x-only arithmetic on the Montgomery model of E0 (see kummer.py). The
+            public keys of the two backends are not interchangeable.
+        pairing: 'weil' or 'tate', the pairing used to validate the public key
+            of the other party (see validate_public_key)
+        '''
+        if backend not in ('weierstrass', 'montgomery'):
+            raise ValueError(f"Unknown backend: {backend}")
+        if pairing not in ('weil', 'tate'):
+            raise ValueError(f"Unknown pairing: {pairing}")
+        # t_B(P, Q) = e_B(P, Q)^(-(p+1)/B), the Tate check is only as strong as the
+        # Weil one when (p+1)/B = A*f is invertible modulo B
+        if pairing == 'tate' and gcd(parameters.B, parameters.f) != 1:
+            print(f"{Back.YELLOW}gcd(B, f) != 1, validating with the Weil pairing{Style.RESET_ALL}")
+            pairing = 'weil'
         self.parameters = parameters
+        self.decomposition = decomposition
+        self.processes = processes
+        self.backend = backend
+        self.pairing = pairing
+
+    def kummer_parameters(self):
+        pr = self.parameters
+        return kummer.kummer_parameters(pr, pr.E0, kummer.prime_factors(pr.Af), kummer.prime_factors(pr.Bf))
+
+    def encode_public_key(self, public_key):
+        return encoding.encode_public_key(public_key, self.backend)
+
+    def decode_public_key(self, data):
+        return encoding.decode_public_key(data, self.parameters.E0.base_field(), self.backend)
 
     def get_public_parameters(self):
         return self.parameters
@@ -425,41 +1256,168 @@ class MSIDH_Party_B(DH_interface):
 
     def compute_public_key(self, private_key):
         pr = self.parameters
-        KB = pr.PB + private_key[1] * pr.QB
+        if self.backend == 'montgomery':
+            kp = self.kummer_parameters()
+            with profile_phase('public_key.kernel'):
+                K = kp.kernel_B(private_key[1])
+            with profile_phase('public_key.isogeny'):
+                curve, images = kummer.isogeny(K, kp.factorsB, kp.curve, [kp.PA, kp.QA, kp.PQA])
+            with profile_phase('public_key.mask'):
+                return kummer.public_key(curve, [kummer.ladder(private_key[0], P, curve) for P in images])
+
+        with profile_phase('public_key.kernel'):
+            KB = pr.PB + private_key[1] * pr.QB
         print("computing isogeny")
-        phiB = EllipticCurveHom_composite(pr.E0, KB, kernel_order=pr.B)
-        print("Computing public key")
-        return ( phiB.codomain(),  private_key[0] * phiB(pr.PA),  private_key[0] * phiB(pr.QA) )
+        with profile_phase('public_key.isogeny'):
+            if self.processes:
+                phiB = EllipticCurveHom_composite(pr.E0, KB, kernel_order=pr.B, decomposition=self.decomposition)
+                print("Computing public key")
+                imPA, imQA = phiB.eval_parallel([pr.PA, pr.QA], self.processes)
+            else:
+                phiB = EllipticCurveHom_composite(pr.E0, KB, kernel_order=pr.B, decomposition=self.decomposition, points=[pr.PA, pr.QA])
+                print("Computing public key")
+                imPA, imQA = phiB.pushed_points()
+        with profile_phase('public_key.mask'):
+            return ( phiB.codomain(), private_key[0] * imPA, private_key[0] * imQA )
 
-    def compute_shared_secret(self, private_key, other_public_key):
-        # Check the Weil pairing values
-        # eB(Rb, Sb) = eB(PB, QB) ** A
-        # Uses sage's implementation of the Weil pairing
+    def validate_public_key(self, other_public_key):
+        '''
+        Check that the public key (E, R, S) of A satisfies e_B(R, S) = e_B(PB, QB)^A,
+        with the Weil pairing or with the reduced Tate pairing (one Miller loop
+        instead of two). Both sides of the check pair points that only the key
+        determines, so only the reference values can be precomputed.
+        '''
         pr = self.parameters
-        Rb = other_public_key[1]
-        Sb = other_public_key[2]
-        p1 = Rb.weil_pairing(Sb, pr.B)
-        p2 = pr.PB.weil_pairing(pr.QB, pr.B) ** pr.A
+        if self.backend == 'montgomery':
+            _, R, S = kummer.lift_basis(*other_public_key)
+        else:
+            R, S = other_public_key[1], other_public_key[2]
+        if self.pairing == 'tate':
+            return reduced_tate_pairing(R, S, pr.B, pr.p) == pr.tate_B
+        return R.weil_pairing(S, pr.B) == pr.pairing_B
+
+    def compute_shared_secret(self, private_key, other_public_key):
+        with profile_phase('shared_secret.validation'):
+            assert self.validate_public_key(other_public_key), "Pairing values do not match"
+        return self._shared_secret(private_key, other_public_key)
 
-        assert p1 == p2, "Weil pairing values do not match"
+    def _shared_secret(self, private_key, other_public_key):
+        '''
+        Shared secret with a public key that has already been validated
+        '''
+        pr = self.parameters
+        if self.backend == 'montgomery':
+            kp = self.kummer_parameters()
+            A, xR, xS, xRS = other_public_key
+            curve = kummer.montgomery_curve(A)
+            with profile_phase('shared_secret.kernel'):
+                K = kummer.ladder3pt(private_key[1], (xR, 1), (xS, 1), (xRS, 1), curve, bits=kp.bitsB)
+            with profile_phase('shared_secret.isogeny'):
+                curve, _ = kummer.isogeny(K, kp.factorsB, curve)
+            return kummer.j_invariant(curve)
 
-        LB = other_public_key[1] + private_key[1] * other_public_key[2]
-        psiB = EllipticCurveHom_composite(other_public_key[0], LB, kernel_order=pr.B)
+        with profile_phase('shared_secret.kernel'):
+            LB = other_public_key[1] + private_key[1] * other_public_key[2]
+        with profile_phase('shared_secret.isogeny'):
+            psiB = EllipticCurveHom_composite(other_public_key[0], LB, kernel_order=pr.B, decomposition=self.decomposition)
         return psiB.codomain().j_invariant()
 
 
-import os.path
-def create_protocol(settings_class, additional_parameter=None):
+# Party and key of the batch server, set before its workers fork
+_batch_party = None
+_batch_private_key = None
+
+def _batch_exchange(public_key):
+    '''
+    Shared secret with one peer in a batch server worker, None if the peer key
+    is rejected. With an ephemeral server key, a fresh key pair is generated and
+    (server public key, shared secret) is returned.
+    '''
+    private_key = _batch_private_key
+    own_public_key = None
+    if private_key is None:
+        private_key = _batch_party.generate_private_key()
+        own_public_key = _batch_party.compute_public_key(private_key)
+    # Validated explicitly rather than by the assert of compute_shared_secret,
+    # which python -O removes. A malformed key must not end the whole batch.
+    try:
+        if _batch_party.validate_public_key(public_key):
+            secret = _batch_party._shared_secret(private_key, public_key)
+        else:
+            secret = None
+    except (ValueError, ArithmeticError):
+        secret = None
+    return secret if _batch_private_key is not None else (own_public_key, secret)
+
+class MSIDH_BatchServer:
+    def __init__(self, parameters, processes=None, ephemeral=False, **party_options):
+        '''
+        Server side (party A) of many key exchanges on one parameter set. The
+        parameter dependent data (pairing references, and the Montgomery model and
+        basis differences for the montgomery backend) is computed once here,
+        before a pool of processes workers is forked, so that every exchange
+        reuses it.
+
+        ephemeral: if False, one key pair answers every peer (public_key), if True
+            every exchange generates its own key pair
+        party_options are passed on to MSIDH_Party_A.
+        '''
+        global _batch_party, _batch_private_key
+        self.party = MSIDH_Party_A(parameters, **party_options)
+        self.processes = processes or multiprocessing.cpu_count()
+        self.throughput = None
+
+        if self.party.backend == 'montgomery':
+            self.party.kummer_parameters()
+        parameters._precompute_pairings(self.party.pairing)
+
+        self.private_key = None
+        self.public_key = None
+        if not ephemeral:
+            self.private_key = self.party.generate_private_key()
+            self.public_key = self.party.compute_public_key(self.private_key)
+
+        _batch_party, _batch_private_key = self.party, self.private_key
+        self._pool = multiprocessing.get_context('fork').Pool(self.processes)
+
+    def exchange(self, public_keys):
+        '''
+        Shared secrets with the peers of the given public keys, in order (None
+        for a rejected key). With an ephemeral key, (server public key, shared
+        secret) pairs are returned instead. The throughput of the batch, in
+        exchanges per second, is printed and kept in self.throughput.
+        '''
+        start = time.time_ns()
+        results = self._pool.map(_batch_exchange, public_keys, chunksize=1)
+        elapsed = (time.time_ns() - start) / 1e9
+        self.throughput = len(public_keys) / elapsed
+        print(f"{Back.GREEN}DONE{Style.RESET_ALL} {len(public_keys)} exchanges in {elapsed} s ({self.throughput} exchanges/s)")
+        return results
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def create_protocol(settings_class, additional_parameter=None, **settings_options):
     timer_start = time.time_ns()
         # Generate the parameters
     settings = None
     print(f"{Back.MAGENTA}Generating parameters...{Style.RESET_ALL}")
     if additional_parameter is None:
-        settings = settings_class()
+        settings = settings_class(**settings_options)
     else:
-        settings = settings_class(additional_parameter)
-    with open(f"./models/{settings.name}.pickle", "wb") as f:
-        pickle.dump(settings, f)
+        settings = settings_class(additional_parameter, **settings_options)
+    save_parameters(settings, f"./models/{settings.name}{PARAMETERS_EXTENSION}")
+    if getattr(settings, "checkpoint", None) is not None:
+        # The parameters are saved, a new generation starts from scratch
+        settings.checkpoint.remove()
 
     print(f"{Back.GREEN}DONE{Style.RESET_ALL} {(time.time_ns() - timer_start) / 1e9} s")
 
@@ -468,21 +1426,68 @@ def create_protocol(settings_class, additional_parameter=None):
     return DH_Protocol(partyA, partyB)
 
 
-def create_protocol_from_file(path):
-    with open("./models/" + path, "rb") as f:
-        settings = pickle.load(f)
+def create_protocol_from_file(path, **party_options):
+    '''
+    Load the parameters stored in ./models/<path>, either in the binary format
+    or pickled (.pickle). The party options are passed on to MSIDH_Party_A and
+    MSIDH_Party_B
+    '''
+    if path.endswith(".pickle"):
+        with open("./models/" + path, "rb") as f:
+            settings = pickle.load(f)
+    else:
+        settings = load_parameters("./models/" + path)
 
-    partyA = MSIDH_Party_A(settings)
-    partyB = MSIDH_Party_B(settings)
+    partyA = MSIDH_Party_A(settings, **party_options)
+    partyB = MSIDH_Party_B(settings, **party_options)
     return DH_Protocol(partyA, partyB)
 
 
-def create_g128_protocol():
+def create_protocol_from_store(store, level, **party_options):
+    '''
+    Create the protocol for the parameters of the given security level (or
+    name) of a MSIDH_ParameterStore, the party options are passed on to MSIDH_Party_A and
+    MSIDH_Party_B
+    '''
+    settings = store[level]
+    partyA = MSIDH_Party_A(settings, **party_options)
+    partyB = MSIDH_Party_B(settings, **party_options)
+    return DH_Protocol(partyA, partyB)
+
+
+def create_g128_protocol(**settings_options):
     '''
     Generate the p128 settings
     '''
     time_start = time.time_ns()
-    settings = MSIDHp128()
+    settings = MSIDHp128(**settings_options)
     print(f"{Back.GREEN}DONE{Style.RESET_ALL} {(time.time_ns() - time_start) / 1e9} s")
-    with open(f"./models/MSIDHp128.pickle", "wb") as f:
-        pickle.dump(settings, f)
\ No newline at end of file
+    save_parameters(settings, f"./models/{settings.name}{PARAMETERS_EXTENSION}")
+
+
+def calibrate_velusqrt(settings, samples=16, repeat=3):
+    '''
+    Calibrate the degree from which the factored isogenies use velusqrt,
+    on the field of the given parameters. The crossover is persisted and
+    picked up by every later run on fields of the same size.
+    '''
+    degrees = sorted(l for l in settings.Af + settings.Bf if l > 2 and is_prime(l))
+    step = max(1, len(degrees) // samples)
+    degrees = degrees[::step] + degrees[-1:]
+    print(f"{Back.MAGENTA}Calibrating velusqrt on {len(degrees)} degrees...{Style.RESET_ALL}")
+    crossover = calibrate_velusqrt_crossover(settings.E0, settings.p + 1, degrees, repeat=repeat)
+    print(f"{Back.GREEN}DONE{Style.RESET_ALL} velusqrt crossover: {crossover}")
+    return crossover
+
+def calibrate_isogeny_costs_on(settings, repeat=3):
+    '''
+    Time a single isogeny step of every prime degree dividing A and B on the
+    field of the given parameters, fit the cost model of the isogeny engine
+    (hom_composite.calibrate_isogeny_costs) and persist it with the velusqrt
+    crossover it implies. Returns the model and the timings per degree.
+    '''
+    degrees = sorted(set(kummer.prime_factors(settings.Af + settings.Bf)))
+    print(f"{Back.MAGENTA}Timing isogenies of {len(degrees)} degrees...{Style.RESET_ALL}")
+    model, timings = calibrate_isogeny_costs(settings.E0, settings.p + 1, degrees, repeat=repeat)
+    print(f"{Back.GREEN}DONE{Style.RESET_ALL} cost model: {model}")
+    return model, timings
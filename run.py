@@ -9,9 +9,13 @@
 import os
 import msidh 
 import sidh
+import transport
+import encoding
 import sage.all as sage
+from sage.schemes.elliptic_curves import hom_composite
 import time
 import argparse
+import multiprocessing
 import numpy as np
 
 parser = argparse.ArgumentParser(
@@ -20,7 +24,80 @@ parser = argparse.ArgumentParser(
                     epilog='Written by M.Ranzetti')
 
 
-def test_SIDH(curve, n_rounds=10):
+# Protocol of a benchmark worker process, created once by _init_worker
+_worker_scheme = None
+
+def _init_worker(create_scheme, args, options):
+    global _worker_scheme
+    _worker_scheme = create_scheme(*args, **options)
+
+def _run_worker_round(i):
+    print(f"Round {i+1} (worker {os.getpid()})")
+    return _worker_scheme.run() + (_worker_scheme.transfer, )
+
+def run_parallel_rounds(create_scheme, args, n_rounds, jobs, **options):
+    '''
+    Run n_rounds of the protocol returned by create_scheme(*args, **options) on a pool of
+    jobs worker processes, each creating the protocol (and loading its parameters)
+    once. Returns the result of every round, in order.
+    '''
+    with multiprocessing.get_context('fork').Pool(jobs, initializer=_init_worker, initargs=(create_scheme, args, options)) as pool:
+        return pool.map(_run_worker_round, range(n_rounds), chunksize=1)
+
+def settings_name(filename):
+    '''
+    Name of the MSIDH parameters of a file in the results: the security level
+    for the MSIDH_AES-<level> files, the file name without extension otherwise
+    '''
+    name = os.path.splitext(os.path.basename(filename))[0]
+    return name.split('AES-')[1] if 'AES-' in name else name
+
+def transfer_data(results):
+    '''
+    Average bytes exchanged per round, and encoding / decoding time of the
+    public keys per round in s, from the (success, time, transfer) of the rounds
+    '''
+    transfers = [r[2] for r in results]
+    return {
+        'bytes': np.mean([t['bytes'] for t in transfers]),
+        'encode_time': np.mean([t['encode_time'] for t in transfers]),
+        'decode_time': np.mean([t['decode_time'] for t in transfers]),
+    }
+
+def run_rounds(scheme, n_rounds, concurrent=False, profile=None):
+    '''
+    Run n_rounds of the protocol in this process. If profile is a path, the
+    isogeny steps and the M-SIDH phases of the rounds are recorded (see
+    hom_composite.IsogenyProfile), summarized and exported to it.
+    '''
+    recorder = hom_composite.IsogenyProfile().start() if profile else None
+    results = []
+    try:
+        for i in range(n_rounds):
+            print(f"Round {i+1}/{n_rounds}")
+            results.append(scheme.run(concurrent) + (scheme.transfer, ))
+    finally:
+        if recorder is not None:
+            recorder.stop()
+    if recorder is not None:
+        print_profile(recorder)
+        recorder.export(profile)
+        print(f"Profile written to {profile}")
+    return results
+
+def print_profile(recorder):
+    summary = recorder.summary()
+    print(f"{'l bits':>6} {'steps':>7} {'l range':>15} {'kernel (s)':>12} {'codomain (s)':>14} {'eval (s)':>12}")
+    for bits, b in summary['histogram'].items():
+        print(f"{bits:>6} {b['steps']:>7} {str(b['min_l']) + '-' + str(b['max_l']):>15} "
+              f"{b['kernel']:>12.4f} {b['codomain']:>14.4f} {b['eval']:>12.4f}")
+    for name, phase in summary['phases'].items():
+        print(f"{name}: {phase['time']:.4f} s over {phase['calls']} calls")
+
+def create_SIDH_scheme(curve, backend='weierstrass'):
+    return sidh.create_protocol(sidh.get_curve(curve), backend=backend)
+
+def test_SIDH(curve, n_rounds=10, concurrent=False, jobs=1, backend='weierstrass', profile=None):
     
     # ==============================================================================
     # TEST SIDH
@@ -28,17 +105,17 @@ def test_SIDH(curve, n_rounds=10):
     # ==============================================================================
     print("Testing SIDH protocol...")
 
-    scheme = sidh.create_protocol(sidh.get_curve(curve))
-    results = []
-    for i in range(n_rounds):
-        print(f"Round {i+1}/{n_rounds}")
-        results.append(scheme.run())
+    if jobs > 1:
+        results = run_parallel_rounds(create_SIDH_scheme, (curve,), n_rounds, jobs, backend=backend)
+    else:
+        scheme = create_SIDH_scheme(curve, backend)
+        results = run_rounds(scheme, n_rounds, concurrent, profile)
 
     print(f"Average time: {sum([r[1]for r in results])/n_rounds * 1e-9}s")
     print(f"Failure count: {sum([1 for r in results if not r[0]])}")
 
     average_time = sum([r[1]for r in results])/n_rounds * 1e-9
-    std = np.std([r[1]for r in results])
+    std = np.std([r[1]for r in results]) * 1e-9
     failure_count = sum([1 for r in results if not r[0]])
 
     data = {
@@ -47,10 +124,11 @@ def test_SIDH(curve, n_rounds=10):
         'std': std,
         'failure_count': failure_count
     }
+    data.update(transfer_data(results))
 
     return data
 
-def test_MSIDH(filename, n_rounds=10):
+def test_MSIDH(filename, n_rounds=10, processes=None, concurrent=False, jobs=1, level=None, backend='weierstrass', pairing='weil', profile=None):
 
 
     # ==============================================================================
@@ -65,51 +143,143 @@ def test_MSIDH(filename, n_rounds=10):
     # 
     # ==============================================================================
     print("Testing MSIDH protocol...")
-    scheme = msidh.create_protocol_from_file(filename)
+    if level is not None:
+        # The store is opened before the workers fork, they share its mapped files
+        store = msidh.MSIDH_ParameterStore("./models")
+        create_scheme, args = msidh.create_protocol_from_store, (store, level)
+        filename = store.filename(level)
+    else:
+        create_scheme, args = msidh.create_protocol_from_file, (filename,)
 
-    results = []
-    for i in range(n_rounds):
-        
-        print(f"Round {i+1}/{n_rounds}")
-        results.append(scheme.run())
+    if jobs > 1:
+        results = run_parallel_rounds(create_scheme, args, n_rounds, jobs, backend=backend, pairing=pairing)
+    else:
+        scheme = create_scheme(*args, processes=processes, backend=backend, pairing=pairing)
+        results = run_rounds(scheme, n_rounds, concurrent, profile)
 
 
     print(f"Average time: {sum([r[1]for r in results])/n_rounds * 1e-9}s")
     print(f"Failure count: {sum([1 for r in results if not r[0]])}")
 
     average_time = sum([r[1]for r in results])/n_rounds * 1e-9
-    std = np.std([r[1]for r in results])
+    std = np.std([r[1]for r in results]) * 1e-9
     failure_count = sum([1 for r in results if not r[0]])
 
     data = {
-        'settings': filename.split('AES-')[1].split('.')[0],
+        'settings': settings_name(filename),
         'average_time': average_time,
         'std': std,
         'failure_count': failure_count
     }
+    data.update(transfer_data(results))
+
+    return data
+
+def test_MSIDH_network(filename, sessions=10, concurrency=1, network='tcp', backend='weierstrass', pairing='weil', level=None):
+    '''
+    Run sessions key exchanges between two MSIDH parties over a local socket,
+    at most concurrency at a time. The parameters are read from the file, or
+    from the store of models/ when a level is given.
+    '''
+    print("Testing MSIDH protocol over the network...")
+    if level is not None:
+        store = msidh.MSIDH_ParameterStore("./models")
+        scheme = msidh.create_protocol_from_store(store, level, backend=backend, pairing=pairing)
+        filename = store.filename(level)
+    else:
+        scheme = msidh.create_protocol_from_file(filename, backend=backend, pairing=pairing)
+    path = f"/tmp/msidh-{os.getpid()}.sock" if network == 'unix' else None
+    try:
+        summary = transport.load_test(scheme.interfaceA, scheme.interfaceB, sessions, concurrency,
+                                      processes=2 * concurrency, path=path)
+    finally:
+        if path is not None and os.path.exists(path):
+            os.remove(path)
 
+    data = {'settings': settings_name(filename), 'network': network}
+    data.update(summary)
     return data
 
-def gen_MSIDH128():
-    msidh.create_g128_protocol()
+def gen_MSIDH128(basis='random'):
+    msidh.create_g128_protocol(basis=basis)
+
+def create_msidh(lam, basis='random', processes=None, checkpoint=None, validate=False):
+    msidh.create_protocol(msidh.MSIDHpArbitrary, lam, basis=basis, processes=processes,
+                          checkpoint=checkpoint, validate=validate)
+
+def calibrate_MSIDH(filename):
+    scheme = msidh.create_protocol_from_file(filename)
+    msidh.calibrate_velusqrt(scheme.interfaceA.parameters)
 
-def create_msidh(lam):
-    msidh.create_protocol(msidh.MSIDHpArbitrary, lam) 
+def isogeny_costs_MSIDH(filename, output=None):
+    '''
+    Fit the isogeny cost model on the field of the parameters in filename,
+    optionally writing the timings per degree (in s) to the csv file output
+    '''
+    scheme = msidh.create_protocol_from_file(filename)
+    _, timings = msidh.calibrate_isogeny_costs_on(scheme.interfaceA.parameters)
+    if output:
+        for t in timings:
+            output_data(output, t)
+
+def verify_MSIDH(filename=None, level=None, mode='fast'):
+    '''
+    Verify the MSIDH parameters of filename, or of the given level in models/
+    '''
+    if level is not None:
+        parameters = msidh.MSIDH_ParameterStore("./models")[level]
+    else:
+        parameters = msidh.create_protocol_from_file(filename).interfaceA.parameters
+    timer_start = time.time()
+    valid = parameters.verify_parameters(fast=mode == 'fast')
+    print(f"Verified in {time.time() - timer_start} s")
+    return valid
+
+def report_sizes():
+    '''
+    Print the public key sizes of the MSIDH parameters in models/
+    '''
+    store = msidh.MSIDH_ParameterStore("./models")
+    print(f"{'parameters':>16} {'lambda':>8} {'p bits':>8} {'compressed':>12} {'uncompressed':>14}")
+    for name in store.names():
+        parameters = store[name]
+        sizes = encoding.size_report(parameters.p)
+        print(f"{name:>16} {int(parameters.security_parameter):>8} {sizes['p_bits']:>8} "
+              f"{sizes['compressed']:>12} {sizes['uncompressed']:>14}")
+
+def convert_models():
+    msidh.convert_pickled_parameters("./models")
 
 def output_data(filename, data):
     '''
     Write the data given as an array into csv format
     data: dict of the form {name: [data list]}
+    If the file has other columns, it is rewritten with the union of the
+    columns, the missing values being left empty.
     '''
+    columns = list(data.keys())
 
     # check if file exists
     if not os.path.exists(filename):
         with open(filename, 'w') as f:
-            f.write(','.join(data.keys()) + '\n')
+            f.write(','.join(columns) + '\n')
+    else:
+        with open(filename, 'r') as f:
+            lines = f.read().splitlines()
+        old_columns = lines[0].split(',') if lines else []
+        if old_columns != columns:
+            columns = old_columns + [c for c in columns if c not in old_columns]
+            rows = [dict(zip(old_columns, line.split(','))) for line in lines[1:]]
+            tmp = filename + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(','.join(columns) + '\n')
+                for row in rows:
+                    f.write(','.join(row.get(c, '') for c in columns) + '\n')
+            os.replace(tmp, filename)
 
     with open(filename, 'a') as f:
         # add a line
-        f.write(','.join([str(v) for v in data.values()]) + '\n')
+        f.write(','.join([str(data.get(c, '')) for c in columns]) + '\n')
     print(f"Data written to {filename}")
 
 
@@ -117,28 +287,81 @@ if __name__ == "__main__":
     parser.add_argument('-t', '--test', type=str, choices=['sidh', 'msidh'], help='Test to run (sidh, msidh)')
     parser.add_argument('-c', '--curve', type=str, choices=list(sidh.available_curves.keys()) ,help='Curve to use for SIDH')
     parser.add_argument('-f', '--file', type=str, help='File to use for MSIDH paramters')
+    parser.add_argument('-l', '--level', type=int, help='security level of the MSIDH parameters in models/ to test (instead of -f)')
     parser.add_argument('-r', '--rounds', type=int, default=10, help='Number of rounds to run tests for')
     parser.add_argument('-g', '--gen', type=int, help='generate MSIDH parameters for a given security level')
     parser.add_argument('-g128', '--gen128', action='store_true', help='generate MSIDH-128 parameters')
+    parser.add_argument('--basis', type=str, choices=['random', 'deterministic'], default='random', help='torsion basis generation used with -g / -g128')
+    parser.add_argument('--checkpoint', type=str, default='./checkpoints', help='directory where the stages of a generation with -g are checkpointed, a rerun resumes from them')
+    parser.add_argument('--validate', action='store_true', help='verify the parameters generated with -g')
+    parser.add_argument('-p', '--processes', type=int, help='number of worker processes used to evaluate the MSIDH public key images, or to test the primes with -g')
+    parser.add_argument('--concurrent', action='store_true', help='run Alice and Bob in parallel processes')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of worker processes the rounds are distributed over')
+    parser.add_argument('--backend', type=str, choices=['weierstrass', 'montgomery'], default='weierstrass', help='curve arithmetic used by the parties: Sage Weierstrass points or x-only Montgomery')
+    parser.add_argument('--pairing', type=str, choices=['weil', 'tate'], default='weil', help='pairing used by the MSIDH parties to validate public keys')
+    parser.add_argument('--network', type=str, choices=['tcp', 'unix'], help='run the MSIDH rounds as sessions over a local socket, -j of them at a time')
+    parser.add_argument('--profile', type=str, help='record the isogeny steps and phases of the rounds and export them to this file (.json or .csv)')
+    parser.add_argument('--calibrate', action='store_true', help='calibrate the velusqrt crossover on the MSIDH parameters given with -f')
+    parser.add_argument('--costs', type=str, nargs='?', const='', help='time an isogeny of every degree of the MSIDH parameters given with -f and fit the cost table of the isogeny engine, optionally writing the timings to this csv file')
+    parser.add_argument('--verify', type=str, nargs='?', const='fast', choices=['fast', 'full'], help='verify the MSIDH parameters given with -f or -l (fast: known factorizations and a single pairing per torsion basis, full: generic point orders)')
+    parser.add_argument('--sizes', action='store_true', help='print the public key sizes of the MSIDH parameters in models/')
+    parser.add_argument('--convert', action='store_true', help='convert the pickled parameters in models/ to the binary format')
     args = parser.parse_args()
 
-    if args.gen:
-        create_msidh(args.gen)
+    if args.jobs > 1 and (args.concurrent or args.processes):
+        print("--jobs cannot be combined with --concurrent or -p, the rounds already run in worker processes")
+        exit(1)
+
+    if args.profile and (args.jobs > 1 or args.concurrent or args.network or args.processes):
+        print("--profile only records the rounds run in this process, it cannot be combined with -j, -p, --concurrent or --network")
+        exit(1)
+
+    if args.convert:
+        convert_models()
+    elif args.sizes:
+        report_sizes()
+    elif args.verify:
+        if not args.file and args.level is None:
+            print("Please provide the MSIDH parameters to verify using -f or -l")
+            exit(1)
+        exit(0 if verify_MSIDH(args.file, args.level, args.verify) else 1)
+    elif args.costs is not None:
+        if not args.file:
+            print("Please provide a file to time the isogenies on using -f")
+            exit(1)
+        isogeny_costs_MSIDH(args.file, args.costs)
+    elif args.calibrate:
+        if not args.file:
+            print("Please provide a file to calibrate on using -f")
+            exit(1)
+        calibrate_MSIDH(args.file)
+    elif args.gen:
+        create_msidh(args.gen, args.basis, args.processes, args.checkpoint, args.validate)
     elif args.gen128:
-        gen_MSIDH128()
+        gen_MSIDH128(args.basis)
     elif args.test == 'sidh':
         if not args.curve:
             print("Please provide a curve to use for SIDH using -c")
             exit(1)
-        data = test_SIDH(args.curve, args.rounds)
+        data = test_SIDH(args.curve, args.rounds, args.concurrent, args.jobs, args.backend, args.profile)
         output_data("sidh_results.csv", data)
 
     elif args.test == 'msidh':
-        if not args.file:
-            print("Please provide a file to use for MSIDH using -f")
+        if not args.file and args.level is None:
+            print("Please provide a file to use for MSIDH using -f, or a security level using -l")
             print("You can generate a file using -g <security level>")
             exit(1)
-        data = test_MSIDH(args.file, args.rounds)
+        if args.concurrent and args.processes:
+            print("--concurrent cannot be combined with -p, the parties already run in worker processes")
+            exit(1)
+        if args.processes and args.backend == 'montgomery':
+            print("-p is only used by the weierstrass backend")
+            exit(1)
+        if args.network:
+            data = test_MSIDH_network(args.file, args.rounds, args.jobs, args.network, args.backend, args.pairing, args.level)
+            output_data("msidh_network_results.csv", data)
+            exit(0)
+        data = test_MSIDH(args.file, args.rounds, args.processes, args.concurrent, args.jobs, args.level, args.backend, args.pairing, args.profile)
         output_data("msidh_results.csv", data)
     else:
         print("Invalid arguments, use -h for help")
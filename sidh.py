@@ -9,10 +9,32 @@
 from sage.all import *
 from interface import DH_interface, DH_Protocol
 from colorama import Back, Style
+from sage.schemes.elliptic_curves.hom_composite import EllipticCurveHom_composite
+import kummer
+import encoding
 
 class SIDH_Party_A(DH_interface):
-    def __init__(self, parameters):
+    def __init__(self, parameters, strategy='optimal', backend='weierstrass'):
+        '''
+        strategy: how the prime power isogenies are traversed (see hom_composite)
+        backend: 'weierstrass' for Sage points and isogenies, 'montgomery' for
+            x-only arithmetic on the Montgomery model of the curve (see kummer.py)
+        '''
+        if backend not in ('weierstrass', 'montgomery'):
+            raise ValueError(f"Unknown backend: {backend}")
         self.parameters = parameters
+        self.strategy = strategy
+        self.backend = backend
+
+    def kummer_parameters(self):
+        pr = self.parameters
+        return kummer.kummer_parameters(pr, pr.curve, [pr.lA] * pr.eA, [pr.lB] * pr.eB)
+
+    def encode_public_key(self, public_key):
+        return encoding.encode_public_key(public_key, self.backend)
+
+    def decode_public_key(self, data):
+        return encoding.decode_public_key(data, self.parameters.curve.base_field(), self.backend)
 
     def get_public_parameters(self):
         return self.parameters
@@ -25,18 +47,52 @@ class SIDH_Party_A(DH_interface):
 
     def compute_public_key(self, private_key):
         pr = self.parameters
+        if self.backend == 'montgomery':
+            kp = self.kummer_parameters()
+            K = kp.kernel_A(private_key)
+            curve, images = kummer.isogeny(K, kp.factorsA, kp.curve, [kp.PB, kp.QB, kp.PQB])
+            return kummer.public_key(curve, images)
+
         KA = pr.PA + private_key * pr.QA
-        phiA = pr.curve.isogeny(KA, algorithm="factored")
+        phiA = EllipticCurveHom_composite(pr.curve, KA, kernel_order=pr.lA ** pr.eA, strategy=self.strategy)
         return ( phiA.codomain(), phiA(pr.PB), phiA(pr.QB) )
 
     def compute_shared_secret(self, private_key, other_public_key):
+        pr = self.parameters
+        if self.backend == 'montgomery':
+            kp = self.kummer_parameters()
+            A, xR, xS, xRS = other_public_key
+            curve = kummer.montgomery_curve(A)
+            K = kummer.ladder3pt(private_key, (xR, 1), (xS, 1), (xRS, 1), curve, bits=kp.bitsA)
+            curve, _ = kummer.isogeny(K, kp.factorsA, curve)
+            return kummer.j_invariant(curve)
+
         LA = other_public_key[1] + private_key * other_public_key[2]
-        psiA = other_public_key[0].isogeny(LA, algorithm="factored")
+        psiA = EllipticCurveHom_composite(other_public_key[0], LA, kernel_order=pr.lA ** pr.eA, strategy=self.strategy)
         return psiA.codomain().j_invariant()
     
 class SIDH_Party_B(DH_interface):
-    def __init__(self, parameters):
+    def __init__(self, parameters, strategy='optimal', backend='weierstrass'):
+        '''
+        strategy: how the prime power isogenies are traversed (see hom_composite)
+        backend: 'weierstrass' for Sage points and isogenies, 'montgomery' for
+            x-only arithmetic on the Montgomery model of the curve (see kummer.py)
+        '''
+        if backend not in ('weierstrass', 'montgomery'):
+            raise ValueError(f"Unknown backend: {backend}")
         self.parameters = parameters
+        self.strategy = strategy
+        self.backend = backend
+
+    def kummer_parameters(self):
+        pr = self.parameters
+        return kummer.kummer_parameters(pr, pr.curve, [pr.lA] * pr.eA, [pr.lB] * pr.eB)
+
+    def encode_public_key(self, public_key):
+        return encoding.encode_public_key(public_key, self.backend)
+
+    def decode_public_key(self, data):
+        return encoding.decode_public_key(data, self.parameters.curve.base_field(), self.backend)
 
     def get_public_parameters(self):
         return self.parameters
@@ -49,13 +105,28 @@ class SIDH_Party_B(DH_interface):
 
     def compute_public_key(self, private_key):
         pr = self.parameters
+        if self.backend == 'montgomery':
+            kp = self.kummer_parameters()
+            K = kp.kernel_B(private_key)
+            curve, images = kummer.isogeny(K, kp.factorsB, kp.curve, [kp.PA, kp.QA, kp.PQA])
+            return kummer.public_key(curve, images)
+
         KB = pr.PB + private_key * pr.QB
-        phiB = pr.curve.isogeny(KB, algorithm="factored")
+        phiB = EllipticCurveHom_composite(pr.curve, KB, kernel_order=pr.lB ** pr.eB, strategy=self.strategy)
         return ( phiB.codomain(), phiB(pr.PA), phiB(pr.QA) )
 
     def compute_shared_secret(self, private_key, other_public_key):
+        pr = self.parameters
+        if self.backend == 'montgomery':
+            kp = self.kummer_parameters()
+            A, xR, xS, xRS = other_public_key
+            curve = kummer.montgomery_curve(A)
+            K = kummer.ladder3pt(private_key, (xR, 1), (xS, 1), (xRS, 1), curve, bits=kp.bitsB)
+            curve, _ = kummer.isogeny(K, kp.factorsB, curve)
+            return kummer.j_invariant(curve)
+
         LB = other_public_key[1] + private_key * other_public_key[2]
-        psiB = other_public_key[0].isogeny(LB, algorithm="factored")
+        psiB = EllipticCurveHom_composite(other_public_key[0], LB, kernel_order=pr.lB ** pr.eB, strategy=self.strategy)
         return psiB.codomain().j_invariant()
 
 class SIDH_Parameters:
@@ -236,8 +307,8 @@ def get_curve(curve_name):
         raise Exception(f"Curve {curve_name} not available")
     return available_curves[curve_name]()
 
-def create_protocol(settings):
-    partyA = SIDH_Party_A(settings)
-    partyB = SIDH_Party_B(settings)
+def create_protocol(settings, strategy='optimal', backend='weierstrass'):
+    partyA = SIDH_Party_A(settings, strategy, backend)
+    partyB = SIDH_Party_B(settings, strategy, backend)
     return DH_Protocol(partyA, partyB)
 
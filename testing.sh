@@ -6,6 +6,7 @@ do
     echo "Test $i"
     # Calculate 2 ^ i using bash
     POWER=$((2**$i))
+    # -g writes models/MSIDH_AES-$POWER.msidh, used by the test below
     sage run.py -g $POWER
-    sage run.py -t msidh -r 20 -f MSIDH_AES-$POWER.pickle
+    sage run.py -t msidh -r 20 -j $(nproc) -f MSIDH_AES-$POWER.msidh
 done
\ No newline at end of file
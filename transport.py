@@ -0,0 +1,262 @@
+# ==============================================================================
+# Networked key exchange over asyncio streams (local TCP or Unix sockets)
+#
+# Messages are framed as: kind (1 byte) | payload length (u32) | payload.
+# A session is: PING/PONG to measure the round trip, KEY from the client and
+# KEY from the server, then CONFIRM with a hash of the client shared secret,
+# answered by RESULT (1 if the server found the same secret).
+#
+# The isogeny computations run in a pool of forked worker processes, so one
+# server answers many sessions concurrently while the event loop only moves
+# bytes around.
+#
+# Public keys are sent with the encoding of the parties (see encoding.py),
+# nothing received from the socket is unpickled.
+#
+# Author: Malo RANZETTI
+# Date: Spring 2023
+# ==============================================================================
+
+import asyncio
+import hashlib
+import multiprocessing
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
+from colorama import Back, Style
+import numpy as np
+
+PING, PONG, KEY, CONFIRM, RESULT = b"P", b"O", b"K", b"C", b"R"
+HEADER = struct.Struct(">cI")
+
+# Parties (DH_interface) available to the workers, registered before they fork
+_transport_parties = {}
+
+def register_party(name, party):
+    '''
+    Make the party available to the workers under the given name. Must be
+    called before the executor is created (see create_executor).
+    '''
+    _transport_parties[name] = party
+
+def create_executor(processes=None):
+    return ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('fork'))
+
+def _key_pair(name, serialize):
+    party = _transport_parties[name]
+    serialize = serialize or party.encode_public_key
+    private_key = party.generate_private_key()
+    return private_key, serialize(party.compute_public_key(private_key))
+
+def _shared_secret(name, private_key, other_public_key, deserialize):
+    '''
+    Shared secret with the received public key and its digest, or (None, None)
+    if the party rejects the key. The key is validated explicitly rather than
+    by the assert of compute_shared_secret, which python -O removes.
+    '''
+    party = _transport_parties[name]
+    deserialize = deserialize or party.decode_public_key
+    other_public_key = deserialize(other_public_key)
+    if hasattr(party, 'validate_public_key'):
+        if not party.validate_public_key(other_public_key):
+            return None, None
+        secret = party._shared_secret(private_key, other_public_key)
+    else:
+        secret = party.compute_shared_secret(private_key, other_public_key)
+    return secret, _digest(secret)
+
+def _digest(secret):
+    return hashlib.sha256(str(secret).encode()).digest()
+
+class _Stream:
+    '''
+    Framed messages over a reader/writer pair, counting the bytes on the wire
+    '''
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    async def send(self, kind, payload=b""):
+        self.writer.write(HEADER.pack(kind, len(payload)) + payload)
+        await self.writer.drain()
+        self.bytes_sent += HEADER.size + len(payload)
+
+    async def receive(self):
+        kind, length = HEADER.unpack(await self.reader.readexactly(HEADER.size))
+        payload = await self.reader.readexactly(length)
+        self.bytes_received += HEADER.size + length
+        return kind, payload
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+class KeyExchangeServer:
+    def __init__(self, name, executor, serialize=None, deserialize=None):
+        '''
+        Answer key exchanges with the party registered under name, computing
+        in the executor. Public keys are encoded with the encoding of the party
+        (DH_interface.encode_public_key) unless serialize and deserialize are
+        given. Every session generates its own key pair, which starts as soon
+        as the client connects. The statistics of the finished sessions are
+        kept in self.sessions.
+        '''
+        self.name = name
+        self.executor = executor
+        self.serialize = serialize
+        self.deserialize = deserialize
+        self.sessions = []
+        self._server = None
+
+    async def start(self, host="127.0.0.1", port=0, path=None):
+        '''
+        Listen on the Unix socket path if given, on host:port otherwise.
+        Returns the address listened on.
+        '''
+        if path is not None:
+            self._server = await asyncio.start_unix_server(self._handle, path=path)
+        else:
+            self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        stream = _Stream(reader, writer)
+        start = time.perf_counter()
+        keys = loop.run_in_executor(self.executor, _key_pair, self.name, self.serialize)
+        digest = None
+        success = False
+        try:
+            while True:
+                kind, payload = await stream.receive()
+                if kind == PING:
+                    await stream.send(PONG, payload)
+                elif kind == KEY:
+                    private_key, public_key = await keys
+                    await stream.send(KEY, public_key)
+                    _, digest = await loop.run_in_executor(self.executor, _shared_secret, self.name,
+                                                           private_key, payload, self.deserialize)
+                    if digest is None:
+                        # The public key of the client was rejected
+                        await stream.send(RESULT, b"\x00")
+                        break
+                elif kind == CONFIRM:
+                    success = payload == digest
+                    await stream.send(RESULT, b"\x01" if success else b"\x00")
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except (ValueError, TypeError, KeyError, ArithmeticError):
+            # The public key of the client could not be decoded
+            await stream.send(RESULT, b"\x00")
+        finally:
+            keys.cancel()
+            self.sessions.append({
+                'time': time.perf_counter() - start,
+                'bytes_sent': stream.bytes_sent,
+                'bytes_received': stream.bytes_received,
+                'success': success,
+            })
+            await stream.close()
+
+async def exchange(name, executor, host="127.0.0.1", port=None, path=None,
+                   serialize=None, deserialize=None):
+    '''
+    Run one key exchange with a KeyExchangeServer as the party registered
+    under name. Returns the shared secret and the statistics of the session:
+    round trip time of an empty message, total time, bytes on the wire and
+    whether the server confirmed the secret.
+    '''
+    loop = asyncio.get_running_loop()
+    if path is not None:
+        reader, writer = await asyncio.open_unix_connection(path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    stream = _Stream(reader, writer)
+    start = time.perf_counter()
+    try:
+        await stream.send(PING)
+        await stream.receive()
+        rtt = time.perf_counter() - start
+
+        private_key, public_key = await loop.run_in_executor(executor, _key_pair, name, serialize)
+        await stream.send(KEY, public_key)
+        kind, other_public_key = await stream.receive()
+        if kind != KEY:
+            raise ConnectionError("The server rejected the public key")
+        secret, digest = await loop.run_in_executor(executor, _shared_secret, name,
+                                                    private_key, other_public_key, deserialize)
+        if digest is None:
+            raise ValueError("The public key of the server was rejected")
+        await stream.send(CONFIRM, digest)
+        _, result = await stream.receive()
+    finally:
+        await stream.close()
+
+    return secret, {
+        'rtt': rtt,
+        'time': time.perf_counter() - start,
+        'bytes_sent': stream.bytes_sent,
+        'bytes_received': stream.bytes_received,
+        'success': result == b"\x01",
+    }
+
+async def _load_test(sessions, concurrency, executor, path, serialize, deserialize):
+    server = KeyExchangeServer("server", executor, serialize, deserialize)
+    address = await server.start(path=path)
+    port = None if path is not None else address[1]
+    limit = asyncio.Semaphore(concurrency)
+
+    async def session():
+        async with limit:
+            start = time.perf_counter()
+            try:
+                _, stats = await exchange("client", executor, port=port, path=path,
+                                          serialize=serialize, deserialize=deserialize)
+            except (ConnectionError, ValueError, asyncio.IncompleteReadError) as e:
+                print(f"{Back.RED}Session failed: {e!r}{Style.RESET_ALL}")
+                stats = {'rtt': float('nan'), 'time': time.perf_counter() - start,
+                         'bytes_sent': 0, 'bytes_received': 0, 'success': False}
+            return stats
+
+    start = time.perf_counter()
+    try:
+        results = await asyncio.gather(*(session() for _ in range(sessions)))
+    finally:
+        await server.close()
+    return results, time.perf_counter() - start
+
+def load_test(server_party, client_party, sessions=8, concurrency=4, processes=None, path=None,
+              serialize=None, deserialize=None):
+    '''
+    Run sessions key exchanges between client_party and a server running
+    server_party (DH_interface objects), at most concurrency at a time, over
+    the Unix socket path if given or local TCP otherwise. Returns a summary of
+    the latencies, round trip times, bytes on the wire and throughput.
+    '''
+    register_party("server", server_party)
+    register_party("client", client_party)
+    with create_executor(processes) as executor:
+        results, elapsed = asyncio.run(_load_test(sessions, concurrency, executor, path, serialize, deserialize))
+
+    times = [r['time'] for r in results]
+    summary = {
+        'sessions': sessions,
+        'concurrency': concurrency,
+        'average_time': float(np.mean(times)),
+        'std': float(np.std(times)),
+        'average_rtt': float(np.nanmean([r['rtt'] for r in results])),
+        'bytes_per_session': float(np.mean([r['bytes_sent'] + r['bytes_received'] for r in results])),
+        'throughput': sessions / elapsed,
+        'failure_count': sum(1 for r in results if not r['success']),
+    }
+    print(f"{Back.GREEN}DONE{Style.RESET_ALL} {sessions} sessions in {elapsed} s ({summary['throughput']} sessions/s)")
+    print(f"Average session time: {summary['average_time']} s, average RTT: {summary['average_rtt'] * 1e3} ms")
+    print(f"Bytes per session: {summary['bytes_per_session']}")
+    return summary